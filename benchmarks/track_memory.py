@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+""" Compare the memory (and attribute read time) of holding a library's
+worth of database tracks as slotted TrackRecords, against the TrackDB
+objects the library used to give out. Run it from the top of the
+repository with:
+  PYTHONPATH=. python benchmarks/track_memory.py
+"""
+
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+
+from trackinggeek.track import TrackDB, TrackRecord
+
+
+def parse_args():
+    parser = ArgumentParser()
+    nh = "The number of tracks to make"
+    parser.add_argument("-n", "--count", type=int, default=100000, help=nh)
+    return parser.parse_args()
+
+
+def make_row(number):
+    """ Make up the data for a track, as TrackLibraryDB reads it. Every
+    value is a new object, like it is when it comes out of sqlite.
+    """
+    start = datetime(2012, 1, 1, tzinfo=timezone.utc) + \
+        timedelta(hours=number)
+    sha1 = "%040x" % number
+    return {"path": "/library/vault/%s/%s.gpx" % (sha1[:2], sha1),
+            "sha1": sha1,
+            "length_3d": 10000.0 + number, "length_2d": 9900.0 + number,
+            "min_elevation": 10.0 + number, "max_elevation": 90.0 + number,
+            "min_latitude": 51.5 + number * 1e-6,
+            "max_latitude": 51.6 + number * 1e-6,
+            "min_longitude": -0.2 + number * 1e-6,
+            "max_longitude": -0.1 + number * 1e-6,
+            "min_speed": 0.0, "max_speed": 8.0 + number * 1e-6,
+            "min_time": start, "max_time": start + timedelta(hours=1),
+            "point_count": 1000 + number, "segment_count": 1}
+
+
+def make_tuple(row):
+    return tuple(row.values())
+
+
+def measure(name, make_track, count):
+    tracemalloc.start()
+    tracks = [make_track(make_row(number)) for number in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.time()
+    if make_track is not make_tuple:
+        # Like the auto-ranging in GenericImageOutput
+        min(track.min_latitude for track in tracks)
+        max(track.max_time for track in tracks)
+    elapsed = time.time() - start
+    print("%-11s %8.1f MB %6i bytes/track %8.3f s to read the ranges" % (
+        name, size / 1e6, size / count, elapsed))
+
+
+def main():
+    args = parse_args()
+    print("%i tracks" % args.count)
+    # Just the values themselves, for comparison
+    measure("Values only", make_tuple, args.count)
+    measure("TrackDB", TrackDB, args.count)
+    measure("TrackRecord", TrackRecord, args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,58 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
-from trackinggeek.point import Point
-from trackinggeek.colour import DEFAULT_COLOUR, DEFAULT_PALETTE
-from trackinggeek.util import mercator_adjust
-from trackinggeek.config import ConfigError
+import numpy as np
+from trackinggeek.colour import lookup_colours
+from trackinggeek.engines import get_engine
+from trackinggeek.pngwriter import rgb_to_argb32
+from trackinggeek.util import (mercator_adjust, mercator_adjust_array,
+                               mercator_unadjust, speeds_between)
+
+# How many heatmap samples we collect before adding them to the counts
+HEATMAP_CHUNK_SIZE = 1 << 20
+
+
+def get_clip_window(resolution, latitude_range, longitude_range, settings):
+    """ Get the (min latitude, max latitude, min longitude, max longitude)
+    that a pair of points has to reach into to show up on an image. That's
+    the map, plus a margin for the widest line we might draw (and its
+    anti-aliasing) to reach in from outside.
+    """
+    pixel_width, pixel_height = resolution
+    min_merc_latitude, max_merc_latitude = map(mercator_adjust,
+                                               latitude_range)
+    min_longitude, max_longitude = longitude_range
+    width = 1.0
+    if settings.colour_type != "heatmap":
+        if settings.linewidth_is_constant:
+            width = max(width, settings.linewidth)
+        else:
+            width = max(width, settings.linewidth_min,
+                        settings.linewidth_max)
+    # In pixels, including the half pixel we shift everything by
+    margin = width / 2.0 + 2
+    lon_margin = margin * (max_longitude - min_longitude) / pixel_width
+    merc_margin = margin * (max_merc_latitude - min_merc_latitude) / \
+        pixel_height
+    return (mercator_unadjust(min_merc_latitude - merc_margin),
+            mercator_unadjust(max_merc_latitude + merc_margin),
+            min_longitude - lon_margin, max_longitude + lon_margin)
+
+
+def get_start_time(points, segment):
+    """ The time that colouring by "starttime" uses for a segment of a
+    PointCache: that of its second point, like the first pair of points
+    """
+    start, end = int(points.offsets[segment]), int(points.offsets[segment + 1])
+    if end - start < 2:
+        return None
+    return points.time[start + 1]
+
+
+def _datetime_to_seconds(mytime):
+    if mytime is None:
+        return None
+    return mytime.timestamp()
 
 
 class Canvas(object):
@@ -26,7 +73,16 @@ class Canvas(object):
     in a selection of formats
     """
     def __init__(self, resolution, latitude_range, longitude_range,
-                 speed_range, elevation_range, time_range, config):
+                 speed_range, elevation_range, time_range, config,
+                 settings=None, svg_path=None):
+        """ settings is the RenderSettings to draw with. If it isn't given,
+        it's resolved from the config.
+
+        If svg_path is given, we draw straight into an svg file there (see
+        finish). Otherwise we draw into a raster image in memory, which
+        can be saved with save_png. The drawing itself is done by the
+        engine named in the settings (see engines.py).
+        """
         self.pixel_width, self.pixel_height = resolution
         self.min_merc_latitude, self.max_merc_latitude = map(mercator_adjust,
                                                              latitude_range)
@@ -36,163 +92,368 @@ class Canvas(object):
         self.min_speed, self.max_speed = speed_range
         self.min_elevation, self.max_elevation = elevation_range
         self.start_time, self.end_time = time_range
+        # The point cache has times in unix seconds, so keep the range in
+        # the same units
+        self._start_seconds = _datetime_to_seconds(self.start_time)
+        self._end_seconds = _datetime_to_seconds(self.end_time)
         self.config = config
+        if settings is None:
+            settings = config.get_render_settings()
+        self.settings = settings
+        self.stroke_count = 0
+        # The number of points we've been given, and how many of them were
+        # left after simplifying and decimating
+        self.points_in = 0
+        self.points_drawn = 0
+        self.svg_path = svg_path
+        # For heatmaps, the number of samples that have landed in each
+        # pixel, and the pixel indexes we haven't counted yet
+        self.heat = None
+        self._heat_samples = []
+        self._heat_sample_count = 0
+        if self.settings.colour_type == "heatmap":
+            self.heat = np.zeros(int(self.pixel_width) *
+                                 int(self.pixel_height), dtype=np.int64)
+        self._clip_window = get_clip_window(resolution, latitude_range,
+                                            longitude_range, settings)
         self.setup_context()
 
     def setup_context(self):
-        self.surface = cairo.SVGSurface("/tmp/test.svg",
-                                        float(self.pixel_width),
-                                        float(self.pixel_height))
-        self.ctx = cairo.Context(self.surface)
-        self.ctx.scale(float(self.pixel_width), float(self.pixel_height))
-
-        bkg = self.config.get_background()
-        if bkg:
-            if len(bkg) == 3:
-                self.ctx.set_source_rgb(*bkg)
-            elif len(bkg) == 4:
-                self.ctx.set_source_rgba(*bkg)
-            self.ctx.paint()
-
-    def _convert_to_fraction(self, point):
-        """ Convert a lat/long point into an (x,y) fraction of the drawing area
-        """
-        # TODO: this could be neater. The addition / subtraction should
-        # be (a) consistently one or the other, and (b) we should adjust
-        # the image width to take it into account.
-        # Add half a pixel width so that we're drawing in the centre of
-        # a pixel, not on the edge
-        x = 0.5 / self.pixel_width + (point.long - self.min_longitude) / \
-            (self.max_longitude - self.min_longitude)
-        merc_lat = mercator_adjust(point.lat)
-        # Subtract half a pixel width so that we're drawing in the
+        self.engine = get_engine(self.settings.engine, self.pixel_width,
+                                 self.pixel_height, self.settings.background,
+                                 self.svg_path)
+
+    def _convert_to_fractions(self, latitudes, longitudes):
+        """ Convert arrays of latitudes and longitudes into arrays of x and y
+        fractions of the drawing area, in one go
+        """
+        # Shift everything by half a pixel so that we're drawing in the
         # centre of a pixel, not on the edge
-        y = 1 - (0.5 / self.pixel_height) - \
-                (merc_lat - self.min_merc_latitude) / self.merc_latitude_width
-        return (x, y)
+        xs = 0.5 / self.pixel_width + (longitudes - self.min_longitude) / \
+            (self.max_longitude - self.min_longitude)
+        merc_lats = mercator_adjust_array(latitudes)
+        ys = 1 - (0.5 / self.pixel_height) - \
+            (merc_lats - self.min_merc_latitude) / self.merc_latitude_width
+        return xs, ys
+
+    def _get_lod_tolerance(self):
+        """ How far (in degrees, see lod.py) a simplified track can stray
+        from the real one without it showing, given settings.decimate
+        """
+        merc_height = self.merc_latitude_width / self.pixel_height
+        width = (self.max_longitude - self.min_longitude) / self.pixel_width
+        return self.settings.decimate * min(merc_height, width)
 
     def _draw_track(self, track):
-        base_colour = self.config.get_basecolour() or DEFAULT_COLOUR
-        variabletrack = not self.config.colour_is_constant() or \
-                        not self.config.linewidth_is_constant()
-        for segment in track.get_segments():
-            point_generator = (p for p in segment.points)
-            first = next(point_generator)
-            pixels = self._convert_to_fraction(Point(first.latitude,
-                                                     first.longitude))
-            self.ctx.move_to(*pixels)
-            previous_point = first
-            starttime = None
-
-            for eachpoint in point_generator:
-                next_point = Point(eachpoint.latitude,
-                                   eachpoint.longitude)
-                pixels = self._convert_to_fraction(next_point)
-                self.ctx.line_to(*pixels)
-                if not variabletrack:
-                    continue
-                speed = eachpoint.speed_between(previous_point)
-                elevation = eachpoint.elevation
-                pointtime = eachpoint.time
-                if starttime is None:
-                    starttime = pointtime
-                # pointtime = eachpoint.
-                kwargs = {"speed": speed,
-                          "elevation": elevation,
-                          "starttime": starttime,
-                          "pointtime": pointtime}
-                current_colour = self._get_colour(**kwargs)
-                current_width = self._get_linewidth(**kwargs)
-                self.ctx.set_source_rgb(*current_colour)  # Solid color
-                self.ctx.set_line_cap(cairo.LINE_CAP_ROUND)
-                self.ctx.set_line_join(cairo.LINE_JOIN_ROUND)
-                self.ctx.set_line_width(current_width / self.pixel_width)
-                self.ctx.stroke()
-                # Start next line
-                self.ctx.move_to(*pixels)
-                previous_point = eachpoint
-
-            if not variabletrack:
-                self.ctx.set_source_rgb(*base_colour)  # Solid color
-                self.ctx.set_line_cap(cairo.LINE_CAP_ROUND)
-                self.ctx.set_line_join(cairo.LINE_JOIN_ROUND)
-                self.ctx.set_line_width(1.0 / self.pixel_width)
-                self.ctx.stroke()
-
-    def _get_colour(self, **kwargs):
-        lw_type = self.config.get_colour_type()
-        if lw_type == "constant":
-            return(self.config.get_colour())
-        try:
-            palette = self.config.get_palette()
-        except ConfigError:
-            print("Warning: no palette in config")
-            palette = DEFAULT_PALETTE
-        if lw_type == "elevation":
-            elevation = kwargs["elevation"]
-            if elevation > self.max_elevation:
-                return palette.interpolate(1.0)
-            if elevation < self.min_elevation:
-                return palette.interpolate(0.0)
-            fraction = (elevation - self.min_elevation) / \
-                       (self.max_elevation - self.min_elevation)
-            return palette.interpolate(fraction)
-        if lw_type == "speed":
-            speed = kwargs["speed"]
-            if speed is None:
-                return palette.interpolate(0.0)
-            if speed > self.max_speed:
-                return palette.interpolate(1.0)
-            if speed < self.min_speed:
-                return palette.interpolate(0.0)
-            fraction = (speed - self.min_speed) / \
-                       (self.max_speed - self.min_speed)
-            return palette.interpolate(fraction)
-        if lw_type in ["pointtime", "starttime"]:
-            starttime = kwargs[lw_type]
-            if starttime > self.end_time:
-                return palette.interpolate(1.0)
-            if starttime < self.start_time:
-                return palette.interpolate(0.0)
-            fraction = (starttime - self.start_time) / \
-                       (self.end_time - self.start_time)
-            return palette.interpolate(fraction)
-        raise NotImplementedError
-
-    def _get_linewidth(self, **kwargs):
-        lw_type = self.config.get_linewidth_type()
+        # Tracks from a region query only need the points in the region
+        ranges = track.point_ranges
+        all_points = track.get_points()
+        if ranges is None:
+            self.points_in += all_points.point_count
+            segment_numbers = range(all_points.segment_count)
+        else:
+            self.points_in += sum(end - start for _, start, end in ranges)
+            # We draw each range as a segment of its own
+            segment_numbers = [segment for segment, _, _ in ranges]
+        if self.settings.decimate:
+            points = track.get_simplified_points(self._get_lod_tolerance(),
+                                                 ranges)
+        elif ranges is None:
+            points = all_points
+        else:
+            points = all_points.get_ranges(ranges)
+        # Colouring by start time goes by the whole of each segment of the
+        # track, not just the points of it that we draw
+        for number, segment in zip(segment_numbers, points.get_segments()):
+            self._draw_segment(segment, get_start_time(all_points, number))
+
+    def draw_segment(self, segment, start_time=None):
+        """ Draw one segment of a track (a PointCache, see
+        PointCache.get_segments). If this is only part of the segment,
+        start_time is the time of the whole (see get_start_time).
+        """
+        self.points_in += segment.point_count
+        self._draw_segment(segment, start_time)
+
+    def _decimate(self, segment, xs, ys):
+        """ Leave out points that are in the same settings.decimate pixel
+        square as the point before, since they wouldn't change the image.
+        The first and last points are always kept.
+        """
+        size = self.settings.decimate
+        if not size or len(xs) < 3:
+            return segment, xs, ys
+        cell_xs = np.floor(xs * (self.pixel_width / size))
+        cell_ys = np.floor(ys * (self.pixel_height / size))
+        keep = np.empty(len(xs), dtype=bool)
+        keep[0] = keep[-1] = True
+        keep[1:-1] = (cell_xs[1:-1] != cell_xs[:-2]) | \
+            (cell_ys[1:-1] != cell_ys[:-2])
+        if keep.all():
+            return segment, xs, ys
+        indexes = np.flatnonzero(keep)
+        return segment.take(indexes), xs[indexes], ys[indexes]
+
+    def _clip(self, segment):
+        """ Split a segment into the runs of points that can show up on
+        the image, leaving out any pairs of points that are both off the
+        same side of it. The runs are views on the segment's arrays.
+        """
+        min_lat, max_lat, min_lon, max_lon = self._clip_window
+        lats, lons = segment.latitude, segment.longitude
+        if len(lats) < 2:
+            inside = (min_lat <= lats) & (lats <= max_lat) & \
+                (min_lon <= lons) & (lons <= max_lon)
+            return [segment] if inside.all() else []
+        lat0, lat1, lon0, lon1 = lats[:-1], lats[1:], lons[:-1], lons[1:]
+        visible = ~(((lat0 < min_lat) & (lat1 < min_lat)) |
+                    ((lat0 > max_lat) & (lat1 > max_lat)) |
+                    ((lon0 < min_lon) & (lon1 < min_lon)) |
+                    ((lon0 > max_lon) & (lon1 > max_lon)))
+        if visible.all():
+            return [segment]
+        # Where each run of visible pairs starts and ends
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], visible,
+                                                       [False]))))
+        # Pair i goes from point i to point i + 1
+        return [segment.get_slice(start, end + 1)
+                for start, end in zip(edges[::2].tolist(),
+                                      edges[1::2].tolist())]
+
+    def _draw_segment(self, segment, start_time=None):
+        # Colouring by start time uses the time of the whole segment, even
+        # if we only draw some of it
+        if start_time is None:
+            start_time = get_start_time(segment, 0)
+        for run in self._clip(segment):
+            self._draw_run(run, start_time)
+
+    def _draw_run(self, segment, start_time):
+        xs, ys = self._convert_to_fractions(segment.latitude,
+                                            segment.longitude)
+        segment, xs, ys = self._decimate(segment, xs, ys)
+        self.points_drawn += len(xs)
+        if self.heat is not None:
+            self._add_heat(xs, ys)
+            return
+        if self.settings.is_constant:
+            self.engine.draw_line(xs, ys, self.settings.base_colour, 1.0)
+            self.stroke_count += 1
+            return
+
+        if len(xs) < 2:
+            return
+        colours = self._get_colours(segment, start_time)
+        widths = self._get_linewidths(segment)
+        # Each pair of points gets its own colour and width, but we
+        # draw each run of pairs that look the same as one line
+        changes = np.any(colours[1:] != colours[:-1], axis=1) | \
+            (widths[1:] != widths[:-1])
+        run_starts = [0] + (np.flatnonzero(changes) + 1).tolist()
+        run_ends = run_starts[1:] + [len(xs) - 1]
+        colours = colours.tolist()
+        widths = widths.tolist()
+        for start, end in zip(run_starts, run_ends):
+            # Pair i goes from point i to point i + 1
+            self.engine.draw_line(xs[start:end + 1], ys[start:end + 1],
+                                  colours[start], widths[start])
+            self.stroke_count += 1
+
+    def _add_heat(self, xs, ys):
+        """ Sample a segment at (about) every pixel it passes through, and
+        queue those pixels up to be counted
+        """
+        width, height = int(self.pixel_width), int(self.pixel_height)
+        # In pixels, so that each whole number is a pixel
+        xs = xs * width
+        ys = ys * height
+        x0, x1, y0, y1 = xs[:-1], xs[1:], ys[:-1], ys[1:]
+        # Pairs that are wholly off one side of the image can't add to it
+        visible = ~(((x0 < 0) & (x1 < 0)) | ((x0 >= width) & (x1 >= width)) |
+                    ((y0 < 0) & (y1 < 0)) | ((y0 >= height) & (y1 >= height)))
+        x0, x1, y0, y1 = x0[visible], x1[visible], y0[visible], y1[visible]
+        length = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))
+        steps = np.maximum(np.ceil(length), 1).astype(np.int64)
+        pair = np.repeat(np.arange(len(steps)), steps)
+        step = np.arange(len(pair)) - np.repeat(np.cumsum(steps) - steps,
+                                                steps)
+        along = step / steps[pair]
+        sample_xs = np.concatenate((x0[pair] + (x1 - x0)[pair] * along,
+                                    xs[-1:]))
+        sample_ys = np.concatenate((y0[pair] + (y1 - y0)[pair] * along,
+                                    ys[-1:]))
+        sample_xs = np.floor(sample_xs).astype(np.int64)
+        sample_ys = np.floor(sample_ys).astype(np.int64)
+        inside = (sample_xs >= 0) & (sample_xs < width) & \
+            (sample_ys >= 0) & (sample_ys < height)
+        indexes = sample_ys[inside] * width + sample_xs[inside]
+        self._heat_samples.append(indexes)
+        self._heat_sample_count += len(indexes)
+        if self._heat_sample_count >= HEATMAP_CHUNK_SIZE:
+            self._count_heat()
+
+    def _count_heat(self):
+        """ Add the queued heatmap samples to the counts """
+        if not self._heat_samples:
+            return
+        indexes = np.concatenate(self._heat_samples)
+        self.heat += np.bincount(indexes, minlength=len(self.heat))
+        self._heat_samples = []
+        self._heat_sample_count = 0
+
+    def _get_heat_fractions(self):
+        """ Scale the heatmap counts to fractions from 0 to 1, for looking
+        up in the palette
+        """
+        heat = self.heat
+        top = heat.max()
+        if top == 0:
+            return np.zeros(len(heat))
+        if self.settings.heatmap_scale == "equalize":
+            # Each count's fraction is the share of (non-empty) pixels
+            # with that count or less, so the colours are used evenly
+            counts, inverse = np.unique(heat, return_inverse=True)
+            pixels = np.bincount(inverse)
+            if counts[0] == 0:
+                pixels[0] = 0
+            cumulative = np.cumsum(pixels)
+            return cumulative[inverse] / float(cumulative[-1])
+        return np.log1p(heat) / np.log1p(top)
+
+    def _paint_heatmap(self):
+        """ Colour the heatmap with the palette, replacing everything on
+        the canvas. Pixels that nothing went through are the background.
+        """
+        width, height = int(self.pixel_width), int(self.pixel_height)
+        colours = lookup_colours(self.settings.palette_table,
+                                 self._get_heat_fractions())
+        background = self.settings.background or (0.0, 0.0, 0.0)
+        rgb = np.where((self.heat > 0)[:, None], colours,
+                       np.array(background[:3]))
+        data, stride = rgb_to_argb32(rgb.reshape(height, width, 3))
+        self.engine.clear()
+        self.engine.paint_image_data(data, stride)
+
+    def flush(self):
+        """ Make sure everything drawn so far is on the image. Heatmaps
+        are only coloured in here, as the colours depend on every track.
+        """
+        if self.heat is not None:
+            self._count_heat()
+            self._paint_heatmap()
+
+    def _get_fractions(self, value_type, segment, start_time=None):
+        """ For each pair of points in the segment, get where the value of
+        value_type falls in our range of that value, from 0 to 1. Anything
+        missing (e.g. no elevation) counts as 0. start_time is the time
+        "starttime" colours by, if not the segment's own.
+        """
+        if value_type == "elevation":
+            values = segment.elevation[1:]
+            bottom, top = self.min_elevation, self.max_elevation
+        elif value_type == "speed":
+            values = speeds_between(segment.latitude, segment.longitude,
+                                    segment.elevation, segment.time)
+            bottom, top = self.min_speed, self.max_speed
+        elif value_type == "starttime":
+            # The whole segment is the colour of its first pair of points
+            if start_time is None:
+                start_time = segment.time[1]
+            values = np.full(len(segment.time) - 1, start_time)
+            bottom, top = self._start_seconds, self._end_seconds
+        elif value_type == "pointtime":
+            values = segment.time[1:]
+            bottom, top = self._start_seconds, self._end_seconds
+        else:
+            raise NotImplementedError
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fractions = (values - bottom) / (top - bottom)
+        fractions = np.nan_to_num(np.clip(fractions, 0.0, 1.0), nan=0.0)
+        levels = self.settings.quantize
+        if levels > 1:
+            # Snap to a fixed number of levels, so that neighbouring pairs
+            # are more likely to look the same, and can be drawn together
+            fractions = np.rint(fractions * (levels - 1)) / (levels - 1)
+        return fractions
+
+    def _get_colours(self, segment, start_time=None):
+        """ Get the colour of each pair of points in the segment, as an
+        array of rgb values (see _get_fractions for start_time)
+        """
+        colour_type = self.settings.colour_type
+        if colour_type == "constant":
+            return np.tile(self.settings.colour, (len(segment.time) - 1, 1))
+        fractions = self._get_fractions(colour_type, segment, start_time)
+        return lookup_colours(self.settings.palette_table, fractions)
+
+    def _get_linewidths(self, segment):
+        """ Get the width (in pixels) of each pair of points in the
+        segment, as an array
+        """
+        lw_type = self.settings.linewidth_type
         if lw_type == "constant":
-            return(self.config.get_linewidth())
-        lw_min = self.config.get_linewidth_min()
-        lw_max = self.config.get_linewidth_max()
-        if lw_type == "elevation":
-            elevation = kwargs["elevation"]
-            if elevation > self.max_elevation:
-                return lw_max
-            if elevation < self.min_elevation:
-                return lw_min
-            fraction = 1.0 * (elevation - self.min_elevation) / \
-                             (self.max_elevation - self.min_elevation)
-            width = lw_min + fraction * (lw_max - lw_min)
-            return(width)
-        if lw_type == "speed":
-            speed = kwargs["speed"]
-            if speed > self.max_speed:
-                return lw_max
-            if speed < self.min_speed:
-                return lw_min
-            fraction = 1.0 * (speed - self.min_speed) / \
-                             (self.max_speed - self.min_speed)
-            width = lw_min + fraction * (lw_max - lw_min)
-            return(width)
-        raise NotImplementedError
+            return np.full(len(segment.time) - 1, self.settings.linewidth)
+        if lw_type not in ("elevation", "speed"):
+            raise NotImplementedError
+        lw_min = self.settings.linewidth_min
+        lw_max = self.settings.linewidth_max
+        fractions = self._get_fractions(lw_type, segment)
+        return lw_min + fractions * (lw_max - lw_min)
+
+    def save_png(self, path, compression=None):
+        """ Write the image to a png file. If compression (a zlib level,
+        0-9) is given, the file is compressed that much.
+        """
+        self.engine.save_png(path, compression)
+
+    def get_image_data(self):
+        """ Get a copy of the raster image's pixels, as (data, stride).
+        These are premultiplied ARGB32, as cairo stores them.
+        """
+        return self.engine.get_image_data()
+
+    def get_coverage(self):
+        """ Get how much of each pixel has been drawn on, from 0 to 1, as
+        a float32 array of rows of pixels
+        """
+        data, stride = self.get_image_data()
+        width, height = int(self.pixel_width), int(self.pixel_height)
+        pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, stride)
+        pixels = pixels[:, :width * 4].reshape(height, width, 4)
+        # Alpha is the most significant byte of each native-endian pixel
+        alpha = pixels[:, :, 3 if np.little_endian else 0]
+        return alpha.astype(np.float32) / 255
+
+    def clear(self):
+        """ Make the whole canvas transparent again """
+        self.engine.clear()
+
+    def paint_image_data(self, data, stride):
+        """ Composite pixels from get_image_data (of another canvas the
+        same size) over what we've drawn so far
+        """
+        self.engine.paint_image_data(data, stride)
+
+    def finish(self):
+        """ Finish drawing, which writes out the rest of an svg file. The
+        canvas can't be drawn on afterwards.
+        """
+        self.engine.finish()
 
     def draw_tracks(self, paths):
         counter = 0
         total = len(paths)
+        strokes_before = self.stroke_count
+        points_in_before = self.points_in
+        points_drawn_before = self.points_drawn
         print("Drawing %s tracks" % total)
         for path in paths:
             counter += 1
             if counter % 100 == 0:
                 print("\tDrawn %s of %s" % (counter, total))
             self._draw_track(path)
+        self.flush()
+        print("Drew %s tracks with %s strokes (%s of %s points)" %
+              (total, self.stroke_count - strokes_before,
+               self.points_drawn - points_drawn_before,
+               self.points_in - points_in_before))
@@ -14,8 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import numpy as np
+
 DEFAULT_COLOUR = (0.3, 0.2, 0.5)
 
+# The number of colours in a palette's lookup table
+PALETTE_TABLE_SIZE = 1024
+
 class Palette(dict):
     """ A colour palette, defined as a dictionary with the keys as numbers
     (0-1) with a colour as their values.
@@ -34,6 +39,17 @@ class Palette(dict):
             return _interpolate_colours(colour_fraction, self[previous_value],
                                         self[value])
 
+    def get_table(self, size=PALETTE_TABLE_SIZE):
+        """ Get the palette as a lookup table: an array of size colours,
+        evenly spaced from 0 to 1. Use this with lookup_colours to get many
+        colours at once.
+        """
+        keys = sorted(self.keys())
+        positions = np.linspace(0.0, 1.0, size)
+        channels = [np.interp(positions, keys, [self[k][i] for k in keys])
+                    for i in range(3)]
+        return np.stack(channels, axis=1)
+
 DEFAULT_PALETTE = Palette({0.0:(0,0,0), 1.0:(1,1,1)})
 
 def _interpolate_colours(fraction, start, end):
@@ -42,3 +58,11 @@ def _interpolate_colours(fraction, start, end):
         diff = end[i] - start[i]
         output.append(start[i] + diff * fraction)
     return tuple(output)
+
+
+def lookup_colours(table, fractions):
+    """ Get the colour from a palette lookup table (see Palette.get_table)
+    for each of an array of fractions between 0 and 1
+    """
+    indexes = np.rint(np.asarray(fractions) * (len(table) - 1))
+    return table[indexes.astype(np.intp)]
@@ -4,16 +4,30 @@ try:
 except ImportError:
     from ConfigParser import ConfigParser, NoSectionError, NoOptionError
 from ast import literal_eval
+from collections import namedtuple
 from datetime import date
 from calendar import monthrange
 
-from trackinggeek.colour import Palette
+from trackinggeek.colour import Palette, DEFAULT_COLOUR, DEFAULT_PALETTE
 
 
 class ConfigError(ValueError):
     pass
 
 
+# The default number of levels to snap variable colours and widths to
+DEFAULT_QUANTIZE = 256
+
+DRAWING_ENGINES = ("cairo", "numpy")
+
+# How close (in pixels) points can be before we only draw one of them
+DEFAULT_DECIMATE = 0
+
+TIMELAPSE_UNITS = ("track", "day", "week", "month", "year", "pointtime")
+
+# The default number of seconds each frame of a pointtime timelapse covers
+DEFAULT_TIMELAPSE_INTERVAL = 3600
+
 TRUESTRINGS = ["yes", "y", "1", "true", "t"]
 FALSESTRINGS = ["no", "n", "0", "false", "f"]
 
@@ -36,6 +50,40 @@ def get_multivalue(stringpair):
         raise ConfigError(msg)
 
 
+class RenderSettings(namedtuple("RenderSettings",
+                                ["background", "base_colour",
+                                 "colour_type", "colour", "palette",
+                                 "palette_table",
+                                 "linewidth_type", "linewidth",
+                                 "linewidth_min", "linewidth_max",
+                                 "quantize", "decimate", "engine",
+                                 "heatmap_scale",
+                                 "savememory",
+                                 "min_date", "max_date",
+                                 "namefilter", "nameregex",
+                                 "timelapse_unit", "units_per_frame",
+                                 "timelapse_interval", "timelapse_fade"])):
+    """ Everything the drawing code needs from the config, looked up and
+    converted once (see Config.get_render_settings), so that none of it
+    has to go back to the config file while we're drawing. Settings that
+    don't apply (e.g. linewidth_min with a constant linewidth) are None.
+    """
+    __slots__ = ()
+
+    @property
+    def colour_is_constant(self):
+        return self.colour_type == "constant"
+
+    @property
+    def linewidth_is_constant(self):
+        return self.linewidth_type == "constant"
+
+    @property
+    def is_constant(self):
+        """ Whether every track is drawn in one colour and width """
+        return self.colour_is_constant and self.linewidth_is_constant
+
+
 class Config(ConfigParser):
     def __init__(self, filepath):
         ConfigParser.__init__(self)
@@ -74,11 +122,50 @@ class Config(ConfigParser):
         return int(value)
 
     def get_timelapse_unit(self, override=None):
+        """ Get what each timelapse frame adds: "track", "day", "week",
+        "month" or "year". Plurals (e.g. "days") are accepted too.
+        "pointtime" means each frame adds the points from a fixed amount
+        of time (see get_timelapse_interval).
+        """
         try:
             value = self._generic_single_getter("timelapse", "unit",
                                                 override)
         except ConfigError:
             return "track"
+        value = value.strip().lower()
+        if value.endswith("s"):
+            value = value[:-1]
+        if value not in TIMELAPSE_UNITS:
+            raise ConfigError("Invalid entry for unit in config: %s" % value)
+        return value
+
+    def get_timelapse_interval(self, override=None):
+        """ Get the number of seconds that each frame of a pointtime
+        timelapse covers
+        """
+        try:
+            value = self._generic_single_getter("timelapse", "interval",
+                                                override)
+        except ConfigError:
+            return DEFAULT_TIMELAPSE_INTERVAL
+        value = float(value)
+        if value <= 0:
+            raise ConfigError("Timelapse interval must be positive")
+        return value
+
+    def get_timelapse_fade(self, override=None):
+        """ Get how much of each timelapse frame is kept in the next one
+        (between 0 and 1), so that older tracks fade away. None means
+        tracks don't fade.
+        """
+        try:
+            value = self._generic_single_getter("timelapse", "fade",
+                                                override)
+        except ConfigError:
+            return None
+        value = float(value)
+        if not 0 <= value <= 1:
+            raise ConfigError("Timelapse fade must be from 0 to 1")
         return value
 
     def do_timelapse(self, override=None):
@@ -161,7 +248,8 @@ class Config(ConfigParser):
         """ Get the type of variation in the linewidth
         """
         value = self._generic_single_getter("drawing", "colour", override)
-        if value in ("elevation", "speed", "starttime", "pointtime"):
+        if value in ("elevation", "speed", "starttime", "pointtime",
+                     "heatmap"):
             return value
         try:
             value = self._generic_multi_getter("drawing", "colour", override)
@@ -215,6 +303,69 @@ class Config(ConfigParser):
                                             override)
         return float(value)
 
+    def get_quantize(self, override=None):
+        """ Get the number of levels that variable colours and line widths
+        are snapped to. 0 means they aren't snapped at all.
+        """
+        try:
+            value = self._generic_single_getter("drawing", "quantize",
+                                                override)
+        except ConfigError:
+            return DEFAULT_QUANTIZE
+        return int(value)
+
+    def get_decimate(self, override=None):
+        """ Get how close together (in pixels) points can be before the
+        ones in between are left out. 0 (the default) means every point is
+        drawn.
+        """
+        try:
+            value = self._generic_single_getter("drawing", "decimate",
+                                                override)
+        except ConfigError:
+            return DEFAULT_DECIMATE
+        value = float(value)
+        if value < 0:
+            raise ConfigError("Invalid entry for decimate in config: %s" %
+                              value)
+        return value
+
+    def get_engine(self, override=None):
+        """ Get the name of the engine to draw with (see engines.py)
+        """
+        try:
+            value = self._generic_single_getter("drawing", "engine",
+                                                override)
+        except ConfigError:
+            return "cairo"
+        if value not in DRAWING_ENGINES:
+            raise ConfigError("Invalid entry for engine in config: %s" %
+                              value)
+        return value
+
+    def get_heatmap_scale(self, override=None):
+        """ Get how heatmap counts are scaled before they're coloured:
+        "log", or "equalize" to spread them evenly over the palette
+        """
+        try:
+            value = self._generic_single_getter("drawing", "heatmap_scale",
+                                                override)
+        except ConfigError:
+            return "log"
+        if value not in ("log", "equalize"):
+            raise ConfigError("Invalid entry for heatmap_scale in config: "
+                              "%s" % value)
+        return value
+
+    def get_jobs(self, override=None):
+        """ Get the number of processes to draw with. 0 means one per cpu.
+        """
+        try:
+            value = self._generic_single_getter("drawing", "jobs", override)
+        except ConfigError:
+            return 1
+        return int(value)
+
     def get_inputpath(self, override=None):
         try:
             return self._generic_single_getter("input", "path", override)
@@ -233,6 +384,31 @@ class Config(ConfigParser):
         except ConfigError:
             return None
 
+    def get_png_compression(self, override=None):
+        """ Get the zlib compression level (0-9) for png files, or None to
+        leave it to cairo
+        """
+        try:
+            value = self._generic_single_getter("output", "pngcompression",
+                                                override)
+        except ConfigError:
+            return None
+        value = int(value)
+        if not 0 <= value <= 9:
+            raise ConfigError("pngcompression must be from 0 to 9")
+        return value
+
+    def get_png_writers(self, override=None):
+        """ Get the number of threads to write timelapse frames with. 0
+        means one per cpu.
+        """
+        try:
+            value = self._generic_single_getter("output", "pngwriters",
+                                                override)
+        except ConfigError:
+            return 0
+        return int(value)
+
     def get_outsvg(self, override=None):
         try:
             return self._generic_single_getter("output", "svgpath", override)
@@ -328,5 +504,57 @@ class Config(ConfigParser):
     def colour_is_constant(self):
         return self.get_colour_type() == "constant"
 
+    def get_render_settings(self):
+        """ Resolve everything the drawing code needs into a RenderSettings
+        """
+        colour_type = self.get_colour_type()
+        colour = None
+        palette = None
+        timelapse_fade = self.get_timelapse_fade()
+        if colour_type == "constant":
+            colour = self.get_colour()
+        if colour_type != "constant" or timelapse_fade is not None:
+            # Fading timelapses colour by brightness, through the palette
+            try:
+                palette = self.get_palette()
+            except ConfigError:
+                print("Warning: no palette in config")
+                palette = DEFAULT_PALETTE
+        linewidth_type = self.get_linewidth_type()
+        linewidth = None
+        linewidth_min = None
+        linewidth_max = None
+        if linewidth_type == "constant":
+            linewidth = self.get_linewidth()
+        else:
+            linewidth_min = self.get_linewidth_min()
+            linewidth_max = self.get_linewidth_max()
+        return RenderSettings(background=self.get_background(),
+                              base_colour=(self.get_basecolour() or
+                                           DEFAULT_COLOUR),
+                              colour_type=colour_type,
+                              colour=colour,
+                              palette=palette,
+                              palette_table=(None if palette is None
+                                             else palette.get_table()),
+                              linewidth_type=linewidth_type,
+                              linewidth=linewidth,
+                              linewidth_min=linewidth_min,
+                              linewidth_max=linewidth_max,
+                              quantize=self.get_quantize(),
+                              decimate=self.get_decimate(),
+                              engine=self.get_engine(),
+                              heatmap_scale=self.get_heatmap_scale(),
+                              savememory=self.savememory(),
+                              min_date=self.get_min_date(),
+                              max_date=self.get_max_date(),
+                              namefilter=self.get_namefilter(),
+                              nameregex=self.get_nameregex(),
+                              timelapse_unit=self.get_timelapse_unit(),
+                              units_per_frame=self.get_units_per_frame(),
+                              timelapse_interval=(
+                                  self.get_timelapse_interval()),
+                              timelapse_fade=timelapse_fade)
+
     def linewidth_is_constant(self):
         return self.get_linewidth_type() == "constant"
@@ -0,0 +1,284 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The engines that a Canvas can draw with. They all take lines as arrays
+of x and y fractions of the image (as Canvas._convert_to_fractions gives
+them), and keep their pixels as cairo's ARGB32 format, so that the output
+code doesn't need to know which engine drew an image.
+"""
+
+import cairo
+import numpy as np
+
+from trackinggeek.pngwriter import DEFAULT_COMPRESSION, write_png
+
+
+class CairoEngine(object):
+    """ Draws with cairo, into a raster image in memory or, if svg_path is
+    given, straight into an svg file
+    """
+    def __init__(self, width, height, background=None, svg_path=None):
+        self.width = width
+        self.height = height
+        if svg_path:
+            # Cairo writes to the file as we go, rather than keeping every
+            # stroke in memory
+            self.surface = cairo.SVGSurface(svg_path, float(width),
+                                            float(height))
+        else:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                              int(width), int(height))
+        self.ctx = cairo.Context(self.surface)
+        self.ctx.scale(float(width), float(height))
+
+        if background:
+            if len(background) == 3:
+                self.ctx.set_source_rgb(*background)
+            elif len(background) == 4:
+                self.ctx.set_source_rgba(*background)
+            self.ctx.paint()
+
+    def draw_line(self, xs, ys, colour, width):
+        """ Draw a line through the points, in one colour, width pixels
+        wide
+        """
+        xs = xs.tolist()
+        ys = ys.tolist()
+        self.ctx.move_to(xs[0], ys[0])
+        line_to = self.ctx.line_to
+        for pixels in zip(xs[1:], ys[1:]):
+            line_to(*pixels)
+        self.ctx.set_source_rgb(*colour)  # Solid color
+        self.ctx.set_line_cap(cairo.LINE_CAP_ROUND)
+        self.ctx.set_line_join(cairo.LINE_JOIN_ROUND)
+        self.ctx.set_line_width(width / self.width)
+        self.ctx.stroke()
+
+    def get_image_data(self):
+        self.surface.flush()
+        return bytes(self.surface.get_data()), self.surface.get_stride()
+
+    def paint_image_data(self, data, stride):
+        image = cairo.ImageSurface.create_for_data(bytearray(data),
+                                                   cairo.FORMAT_ARGB32,
+                                                   int(self.width),
+                                                   int(self.height),
+                                                   stride)
+        self.ctx.save()
+        # The image is in pixels, not fractions of the drawing area
+        self.ctx.identity_matrix()
+        self.ctx.set_source_surface(image, 0, 0)
+        self.ctx.paint()
+        self.ctx.restore()
+
+    def clear(self):
+        self.ctx.save()
+        self.ctx.set_operator(cairo.OPERATOR_CLEAR)
+        self.ctx.paint()
+        self.ctx.restore()
+
+    def save_png(self, path, compression=None):
+        if compression is None:
+            self.surface.write_to_png(path)
+            return
+        data, stride = self.get_image_data()
+        write_png(path, data, int(self.width), int(self.height), stride,
+                  compression)
+
+    def finish(self):
+        self.surface.finish()
+
+
+def _expand(counts):
+    """ For groups of the given sizes, get which group each item is in and
+    its position within the group, ie [2, 3] -> [0, 0, 1, 1, 1],
+    [0, 1, 0, 1, 2]
+    """
+    groups = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return groups, np.arange(len(groups)) - starts[groups]
+
+
+class NumpyEngine(object):
+    """ Draws anti-aliased lines straight into a NumPy image, a whole line
+    at a time, with no per-point work in Python.
+
+    Lines are drawn the way Xiaolin Wu's algorithm does it: we step one
+    pixel at a time along whichever axis the line is longer in, and shade
+    the pixels across it by how far they are from the line. For a line one
+    pixel wide, that's exactly Wu's pair of pixels per step; wider lines
+    shade more of them. Ends are squared off rather than rounded.
+    """
+    def __init__(self, width, height, background=None):
+        self.width = int(width)
+        self.height = int(height)
+        # Premultiplied red, green, blue, alpha, from 0 to 1
+        self.pixels = np.zeros((self.height * self.width, 4),
+                               dtype=np.float32)
+        if background:
+            alpha = background[3] if len(background) == 4 else 1.0
+            self.pixels[:, :3] = np.array(background[:3]) * alpha
+            self.pixels[:, 3] = alpha
+
+    def _get_coverage(self, xs, ys, width):
+        """ Work out which pixels the line touches, and how much of each
+        it covers. Returns (pixel indexes, coverage), without repeats.
+        """
+        # In pixels, with pixel centres on whole numbers
+        xs = np.asarray(xs, dtype=np.float64) * self.width - 0.5
+        ys = np.asarray(ys, dtype=np.float64) * self.height - 0.5
+        x0, x1, y0, y1 = xs[:-1], xs[1:], ys[:-1], ys[1:]
+        steep = np.abs(y1 - y0) > np.abs(x1 - x0)
+        # a is the axis we step along, b the one we shade across
+        a0 = np.where(steep, y0, x0)
+        a1 = np.where(steep, y1, x1)
+        b0 = np.where(steep, x0, y0)
+        b1 = np.where(steep, x1, y1)
+        reverse = a1 < a0
+        a0, a1 = np.where(reverse, a1, a0), np.where(reverse, a0, a1)
+        b0, b1 = np.where(reverse, b1, b0), np.where(reverse, b0, b1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(a1 > a0, (b1 - b0) / (a1 - a0), 0.0)
+        # Shading across the line, distances are longer than they are
+        # at right angles to it by this much
+        stretch = np.sqrt(1 + slope * slope)
+        half = width / 2.0
+
+        # How far either side of the line (along b) a pixel can be and
+        # still be touched by it
+        reach = (half + 0.5) * stretch
+
+        # Every step along each pair of points, leaving out any that are
+        # off the image
+        edge = int(np.ceil(half)) + 1
+        size = np.where(steep, self.height, self.width)
+        first = np.maximum(np.floor(a0 - half - 0.5) + 1, -edge)
+        last = np.minimum(np.ceil(a1 + half + 0.5) - 1, size + edge)
+        steps = np.maximum(last - first + 1, 0).astype(np.int64)
+        pair, step = _expand(steps)
+        a = first.astype(np.int64)[pair] + step
+        along = np.clip(a, a0[pair], a1[pair])
+        centre = b0[pair] + (along - a0[pair]) * slope[pair]
+        # How far past the end of the pair we are, for the line's ends
+        end_coverage = np.clip(half + 0.5 - np.abs(a - along), 0.0, 1.0)
+
+        # Every pixel across the line at each step
+        lowest = np.floor(centre - reach[pair]).astype(np.int64) + 1
+        across = np.ceil(centre + reach[pair]).astype(np.int64) - lowest
+        sample, offset = _expand(across)
+        b = lowest[sample] + offset
+        pair = pair[sample]
+        distance = np.abs(b - centre[sample]) / stretch[pair]
+        coverage = np.clip(half + 0.5 - distance, 0.0, 1.0) * \
+            end_coverage[sample]
+
+        a = a[sample]
+        steep = steep[pair]
+        x = np.where(steep, b, a)
+        y = np.where(steep, a, b)
+        keep = (coverage > 0) & (x >= 0) & (x < self.width) & \
+            (y >= 0) & (y < self.height)
+        indexes = y[keep] * self.width + x[keep]
+        coverage = coverage[keep].astype(np.float32)
+        if not len(indexes):
+            return indexes, coverage
+        # Where the line overlaps itself (e.g. at the joins), a pixel is
+        # only as covered as the most covered it's been
+        if len(indexes) * 8 > self.width * self.height:
+            # For big lines, it's quicker to use a whole image's worth
+            merged = np.zeros(self.width * self.height, dtype=np.float32)
+            np.maximum.at(merged, indexes, coverage)
+            indexes = np.flatnonzero(merged)
+            return indexes, merged[indexes]
+        order = np.argsort(indexes, kind="stable")
+        indexes = indexes[order]
+        starts = np.flatnonzero(np.diff(indexes, prepend=-1))
+        return indexes[starts], np.maximum.reduceat(coverage[order], starts)
+
+    def draw_line(self, xs, ys, colour, width):
+        """ Draw a line through the points, in one colour, width pixels
+        wide
+        """
+        if len(xs) < 2:
+            # A single point is drawn as a dot
+            xs = np.repeat(xs, 2)
+            ys = np.repeat(ys, 2)
+        indexes, coverage = self._get_coverage(xs, ys, max(width, 1.0))
+        if width < 1.0:
+            # Thin lines come out fainter, rather than thinner
+            coverage *= width
+        self._blend(indexes, np.array(colour[:3], dtype=np.float32),
+                    coverage)
+
+    def _blend(self, indexes, colour, coverage):
+        """ Lay a colour over the given pixels, as much as coverage says """
+        coverage = coverage[:, None]
+        existing = self.pixels[indexes]
+        existing *= 1 - coverage
+        existing[:, :3] += colour * coverage
+        existing[:, 3:] += coverage
+        self.pixels[indexes] = existing
+
+    def get_image_data(self):
+        """ Get the pixels as cairo's ARGB32 (premultiplied, native-endian)
+        """
+        values = np.rint(np.clip(self.pixels, 0.0, 1.0) * 255)
+        values = values.astype(np.uint8)
+        data = np.empty((len(values), 4), dtype=np.uint8)
+        if np.little_endian:
+            # B, G, R, A in memory
+            data[:, 2::-1] = values[:, :3]
+            data[:, 3] = values[:, 3]
+        else:
+            data[:, 1:] = values[:, :3]
+            data[:, 0] = values[:, 3]
+        return data.tobytes(), self.width * 4
+
+    def paint_image_data(self, data, stride):
+        pixels = np.frombuffer(data, dtype=np.uint8)
+        pixels = pixels.reshape(self.height, stride)[:, :self.width * 4]
+        pixels = pixels.reshape(-1, 4).astype(np.float32) / 255
+        if np.little_endian:
+            source = pixels[:, [2, 1, 0, 3]]
+        else:
+            source = pixels[:, [1, 2, 3, 0]]
+        # Everything's premultiplied, so this is just "over"
+        self.pixels *= 1 - source[:, 3:]
+        self.pixels += source
+
+    def clear(self):
+        self.pixels[:] = 0
+
+    def save_png(self, path, compression=None):
+        if compression is None:
+            compression = DEFAULT_COMPRESSION
+        data, stride = self.get_image_data()
+        write_png(path, data, self.width, self.height, stride, compression)
+
+    def finish(self):
+        pass
+
+
+def get_engine(name, width, height, background=None, svg_path=None):
+    """ Make the engine called name ("cairo" or "numpy") for an image of the
+    given size. Only cairo can draw svg files, so it's always used for
+    those.
+    """
+    if svg_path or name == "cairo":
+        return CairoEngine(width, height, background, svg_path)
+    if name == "numpy":
+        return NumpyEngine(width, height, background)
+    raise ValueError("Unknown drawing engine: %s" % name)
@@ -23,7 +23,7 @@ from trackinggeek.timelapse import Timelapse
 
 
 def OutputImage(pixel_dimensions, latitude_range, longitude_range,
-                elevation_range, speed_range, config):
+                elevation_range, speed_range, config, jobs=1):
     if config.do_timelapse():
         return Timelapse(pixel_dimensions=pixel_dimensions,
                          latitude_range=latitude_range,
@@ -36,7 +36,8 @@ def OutputImage(pixel_dimensions, latitude_range, longitude_range,
                        longitude_range=longitude_range,
                        elevation_range=elevation_range,
                        speed_range=speed_range,
-                       config=config)
+                       config=config,
+                       jobs=jobs)
 
 
 def main():
@@ -65,6 +66,9 @@ def main():
                         help='the latitude range to use, e.g. 43.1,45.6')
     parser.add_argument('--longitude', action='store',
                         help='the longitude range to use, e.g. -2.3,1.2')
+    parser.add_argument('--jobs', '-j', action='store',
+                        help='the number of processes to draw with'
+                        ' (0 for one per cpu)')
     args = parser.parse_args()
 
     pixel_dimensions = {}
@@ -101,13 +105,15 @@ def main():
     outpng = config.get_outpng(args.outpng)
     outsvg = config.get_outsvg(args.outsvg)
     outma = config.get_outma(args.outma)
+    jobs = config.get_jobs(args.jobs)
 
     c = OutputImage(pixel_dimensions=pixel_dimensions,
                     latitude_range=latitude_range,
                     longitude_range=longitude_range,
                     elevation_range=elevation_range,
                     speed_range=speed_range,
-                    config=config)
+                    config=config,
+                    jobs=jobs)
     if inputpath:
         print("Adding input path")
         c.add_path(inputpath)
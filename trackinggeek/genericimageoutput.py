@@ -16,6 +16,7 @@
 
 from datetime import datetime, timezone
 
+from trackinggeek.canvas import get_clip_window
 from trackinggeek.tracklibrary import TrackLibraryDB, OldTrackLibrary
 from trackinggeek.util import mercator_adjust, tracks_from_path
 
@@ -42,6 +43,7 @@ class GenericImageOutput(object):
             self.max_longitude = None
 
         self.config = config
+        self.settings = config.get_render_settings()
         self.pixel_dimensions = pixel_dimensions
 
         # TODO: Have these settable in the config
@@ -65,12 +67,16 @@ class GenericImageOutput(object):
             self.start_time = None
             self.end_time = None
         self.old_track_library = OldTrackLibrary()
+        self.track_library = None
 
     def draw(self):
         raise NotImplementedError
 
     def prepare_to_draw(self):
         # This doesn't do the whole job, hence it's private
+        # Only a map we've been given can leave parts of tracks out
+        cropped = None not in (self.min_latitude, self.max_latitude,
+                               self.min_longitude, self.max_longitude)
         if not self.min_latitude:
             self.min_latitude = self.auto_min_latitude
         if not self.max_latitude:
@@ -86,6 +92,31 @@ class GenericImageOutput(object):
         if self.start_time is None:
             self._detect_time()
         self._calc_pixel_dimensions(self.pixel_dimensions)
+        if cropped and self.track_library is not None:
+            self._find_visible_ranges()
+
+    def _find_visible_ranges(self):
+        """ Narrow the tracks down to those that actually pass through the
+        map, and set their point_ranges so that only the parts that do are
+        read and drawn (see TrackLibraryDB.get_point_ranges). Tracks that
+        aren't in the spatial grid are kept, and drawn whole.
+        """
+        window = get_clip_window((self.pixel_width, self.pixel_height),
+                                 (self.min_latitude, self.max_latitude),
+                                 (self.min_longitude, self.max_longitude),
+                                 self.settings)
+        ranges = self.track_library.get_point_ranges(*window)
+        gridded = self.track_library.get_gridded_sha1s()
+        tracks = set()
+        for track in self.tracks:
+            if track.sha1 in ranges:
+                track.point_ranges = ranges[track.sha1]
+                tracks.add(track)
+            elif track.sha1 not in gridded:
+                tracks.add(track)
+        print("%i of %i tracks pass through the map" % (len(tracks),
+                                                         len(self.tracks)))
+        self.tracks = tracks
 
     def _calc_pixel_dimensions(self, pixel_dimensions):
         """ Calculate the size of the image in pixels, given whatever
@@ -130,8 +161,7 @@ class GenericImageOutput(object):
 
     def _detect_speeds(self):
         # In km/h
-        if self.config.colour_is_constant() and \
-                self.config.linewidth_is_constant():
+        if self.settings.is_constant:
             print("Speed detection not required")
             return
         currmin = None
@@ -149,8 +179,7 @@ class GenericImageOutput(object):
         print("Detected range is %s - %s" % (currmin, currmax))
 
     def _detect_time(self):
-        if self.config.colour_is_constant() and \
-                self.config.linewidth_is_constant():
+        if self.settings.is_constant:
             print("Time range detection not required")
             return
         currmin = None
@@ -169,7 +198,7 @@ class GenericImageOutput(object):
 
     def add_track(self, path):
         tl = self.old_track_library
-        tl.add_track(path, save_memory=self.config.savememory())
+        tl.add_track(path, save_memory=self.settings.savememory)
         if self.max_latitude:
             if tl[path].min_latitude > self.max_latitude or \
                     tl[path].max_latitude < self.min_latitude or \
@@ -177,8 +206,8 @@ class GenericImageOutput(object):
                     tl[path].max_longitude < self.min_longitude:
                 # print("Outside our specified area")
                 return
-        min_date = self.config.get_min_date()
-        max_date = self.config.get_max_date()
+        min_date = self.settings.min_date
+        max_date = self.settings.max_date
         if min_date or max_date:
             if min_date and tl[path].max_date < min_date:
                 # print("Before the specified time range")
@@ -230,8 +259,7 @@ class GenericImageOutput(object):
                 self.auto_max_speed = tl[path].max_speed
 
     def _detect_elevations(self):
-        if self.config.colour_is_constant() and \
-                self.config.linewidth_is_constant():
+        if self.settings.is_constant:
             print("Elevation detection not required")
             return
         currmin = None
@@ -260,8 +288,10 @@ class GenericImageOutput(object):
                 print("\tParsed %i/%i tracks" % (counter, total))
 
     def add_database(self, database_path):
-        self.track_library = TrackLibraryDB(library_dir=database_path)
-        num_tracks = len(self.track_library.get_tracks())
+        self.track_library = TrackLibraryDB(
+            library_dir=database_path,
+            save_memory=self.settings.savememory)
+        num_tracks = self.track_library.count_tracks()
         print("Database contains %i tracks" % num_tracks)
         self.get_refined_tracks()
         print("Found %i tracks to use" % len(self.tracks))
@@ -273,14 +303,14 @@ class GenericImageOutput(object):
         kwargs["max_latitude"] = (self.min_latitude, None)
         kwargs["min_longitude"] = (None, self.max_longitude)
         kwargs["max_longitude"] = (self.min_longitude, None)
-        min_date = self.config.get_min_date()
+        min_date = self.settings.min_date
         if min_date is None:
             min_time = datetime.min.replace(tzinfo=timezone.utc)
         else:
             temp_min_time = datetime.min.time().replace(tzinfo=timezone.utc)
             min_time = datetime.combine(min_date, temp_min_time)
 
-        max_date = self.config.get_max_date()
+        max_date = self.settings.max_date
         if max_date is None:
             max_time = datetime.max.replace(tzinfo=timezone.utc)
         else:
@@ -293,11 +323,11 @@ class GenericImageOutput(object):
         if self.max_speed is not None:
             kwargs["min_speed"] = (None, self.max_speed)
 
-        namefilter = self.config.get_namefilter()
+        namefilter = self.settings.namefilter
         if namefilter is not None:
             kwargs["namefilter"] = namefilter
 
-        nameregex = self.config.get_nameregex()
+        nameregex = self.settings.nameregex
         if nameregex is not None:
             if namefilter is not None:
                 print("WARNING: Both filter and regex specified")
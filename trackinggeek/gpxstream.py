@@ -0,0 +1,198 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Streaming access to gpx files, for when we don't want gpxpy to build
+the whole document in memory just to look at each point once.
+"""
+
+from xml.etree.ElementTree import iterparse
+
+from gpxpy.geo import distance, calculate_max_speed
+from gpxpy.gpx import (DEFAULT_STOPPED_SPEED_THRESHOLD,
+                       IGNORE_TOP_SPEED_PERCENTILES)
+from gpxpy.gpxfield import parse_time
+
+
+def _local_name(tag):
+    """ Strip the namespace from an element tag, so that we can handle gpx
+    1.0 and 1.1 files the same way
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child_text(element, name):
+    for child in element:
+        if _local_name(child.tag) == name:
+            if child.text is None:
+                return None
+            return child.text.strip() or None
+    return None
+
+
+def iter_points(path):
+    """ Iterate over every track point in a gpx file, without keeping the
+    document in memory. Yields tuples of
+      (segment_number, latitude, longitude, elevation, time)
+    where segment_number counts up from 0 across every segment of every
+    track in the file. Elevation and time may be None. Route points and
+    waypoints are ignored, as they are by gpxpy's track statistics.
+    """
+    segment_number = -1
+    in_segment = False
+    stack = []
+    for event, element in iterparse(path, events=("start", "end")):
+        name = _local_name(element.tag)
+        if event == "start":
+            stack.append(element)
+            if name == "trkseg":
+                segment_number += 1
+                in_segment = True
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if name == "trkseg":
+            in_segment = False
+        elif name == "trkpt" and in_segment:
+            latitude = float(element.get("lat"))
+            longitude = float(element.get("lon"))
+            elevation = _child_text(element, "ele")
+            if elevation is not None:
+                elevation = float(elevation)
+            time = _child_text(element, "time")
+            if time is not None:
+                time = parse_time(time)
+            yield (segment_number, latitude, longitude, elevation, time)
+        # Drop what we've finished with (route points and waypoints too),
+        # so memory use doesn't grow with the size of the file. The
+        # children of a track point are kept until we've read it.
+        if parent is not None and _local_name(parent.tag) == "trkpt":
+            continue
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+
+class _SegmentStats(object):
+    """ The running statistics for a single track segment. This mirrors
+    the per-segment calculations in gpxpy, so that the numbers come out
+    the same as they did when we parsed the whole file.
+    """
+    def __init__(self):
+        self.length_2d = 0.0
+        self.length_3d = 0.0
+        self.moving_time = 0.0
+        self.speeds_and_distances = []
+        self.previous = None
+
+    def add_point(self, latitude, longitude, elevation, time):
+        previous = self.previous
+        self.previous = (latitude, longitude, elevation, time)
+        if previous is None:
+            return
+        prev_lat, prev_lon, prev_ele, prev_time = previous
+        dist_2d = distance(latitude, longitude, None,
+                           prev_lat, prev_lon, None)
+        dist_3d = distance(latitude, longitude, elevation,
+                           prev_lat, prev_lon, prev_ele)
+        if dist_2d:
+            self.length_2d += dist_2d
+        if dist_3d:
+            self.length_3d += dist_3d
+        if not (time and prev_time):
+            return
+        if elevation and prev_ele:
+            dist = dist_3d
+        else:
+            dist = dist_2d
+        seconds = (time - prev_time).total_seconds()
+        if seconds <= 0 or not dist:
+            return
+        speed_kmh = (dist / 1000) / (seconds / 60 ** 2)
+        if speed_kmh > DEFAULT_STOPPED_SPEED_THRESHOLD:
+            self.moving_time += seconds
+        if self.moving_time:
+            self.speeds_and_distances.append((dist / seconds, dist))
+
+    def max_speed(self):
+        if not self.speeds_and_distances:
+            return None
+        return calculate_max_speed(self.speeds_and_distances,
+                                   IGNORE_TOP_SPEED_PERCENTILES, True)
+
+
+def extract_stats(path, points=None):
+    """ Work out the statistics that a Track stores (see
+    track._TRACK_ATTRIBUTES) in a single pass over the gpx file. The
+    results match what gpxpy would give us, but only one segment's worth
+    of speed samples are ever held in memory. If points is given, it's
+    used instead of reading the file again, and should be what
+    iter_points(path) would give.
+
+    Returns a dictionary keyed by attribute name (without "path" and
+    "sha1", which aren't stats of the contents)
+    """
+    if points is None:
+        points = iter_points(path)
+    stats = {"min_latitude": None, "max_latitude": None,
+             "min_longitude": None, "max_longitude": None,
+             "min_elevation": None, "max_elevation": None,
+             "min_time": None, "max_time": None,
+             "min_speed": 0, "max_speed": 0.0,
+             "length_2d": 0.0, "length_3d": 0.0,
+             "point_count": 0, "segment_count": 0}
+    current_number = None
+    segment = None
+
+    def add_segment(segment):
+        stats["length_2d"] += segment.length_2d
+        stats["length_3d"] += segment.length_3d
+        speed = segment.max_speed()
+        if speed is not None and speed > stats["max_speed"]:
+            stats["max_speed"] = speed
+
+    for number, lat, lon, ele, time in points:
+        if number != current_number:
+            if segment is not None:
+                add_segment(segment)
+            current_number = number
+            segment = _SegmentStats()
+            stats["segment_count"] += 1
+        segment.add_point(lat, lon, ele, time)
+        stats["point_count"] += 1
+
+        if stats["min_latitude"] is None:
+            stats["min_latitude"] = stats["max_latitude"] = lat
+            stats["min_longitude"] = stats["max_longitude"] = lon
+        else:
+            stats["min_latitude"] = min(stats["min_latitude"], lat)
+            stats["max_latitude"] = max(stats["max_latitude"], lat)
+            stats["min_longitude"] = min(stats["min_longitude"], lon)
+            stats["max_longitude"] = max(stats["max_longitude"], lon)
+        if ele is not None:
+            if stats["min_elevation"] is None:
+                stats["min_elevation"] = stats["max_elevation"] = ele
+            else:
+                stats["min_elevation"] = min(stats["min_elevation"], ele)
+                stats["max_elevation"] = max(stats["max_elevation"], ele)
+        if time is not None:
+            if stats["min_time"] is None:
+                stats["min_time"] = time
+            stats["max_time"] = time
+
+    if segment is None:
+        raise ValueError("Track contains no points: %s" % path)
+    add_segment(segment)
+    return stats
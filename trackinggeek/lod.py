@@ -0,0 +1,221 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Simplified versions of each track (levels of detail), so that a
+zoomed out image doesn't have to read and draw every point.
+
+Each level is a Douglas-Peucker simplification of the track's points, as
+longitude and mercator-adjusted latitude (see util.mercator_adjust), with
+a tolerance from LOD_TOLERANCES in those degrees. Each level is worked out
+from the finer one before it. A level is stored as the indexes of the
+points it keeps in the point cache, in a file next to the point cache:
+  header:     magic, version, point count, segment count, level count
+  tolerances: float64 * level count
+  then for each level:
+    offsets:  int64 * (segment count + 1), into this level's indexes
+    indexes:  int64 * (the last offset)
+Everything is little-endian.
+"""
+
+import os
+import struct
+
+import numpy as np
+
+from trackinggeek.pointcache import get_point_cache_path
+from trackinggeek.util import mercator_adjust_array
+
+LOD_EXTENSION = ".lod"
+# About 1m up to about 1km at the equator, in degrees
+LOD_TOLERANCES = (0.00001, 0.00004, 0.00016, 0.00064, 0.00256, 0.01024)
+
+_MAGIC = b"TGLD"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIQQI")
+
+
+class LODError(IOError):
+    pass
+
+
+def get_lod_path(gpx_path):
+    return os.path.splitext(get_point_cache_path(gpx_path))[0] + \
+        LOD_EXTENSION
+
+
+def simplify(xs, ys, tolerance):
+    """ Get the indexes of the points that the Douglas-Peucker algorithm
+    keeps for a line, with the given tolerance. The first and last points
+    are always kept.
+    """
+    count = len(xs)
+    if count < 3:
+        return np.arange(count)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, count - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        dx = xs[end] - xs[start]
+        dy = ys[end] - ys[start]
+        px = xs[start + 1:end] - xs[start]
+        py = ys[start + 1:end] - ys[start]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            middle = start + 1 + furthest
+            keep[middle] = True
+            ranges.append((start, middle))
+            ranges.append((middle, end))
+    return np.flatnonzero(keep)
+
+
+class LevelsOfDetail(object):
+    """ The simplified levels of a track. levels[i] is (offsets, indexes)
+    for LOD_TOLERANCES[i], where segment j of that level is the points at
+    indexes[offsets[j]:offsets[j + 1]] in the point cache.
+    """
+    def __init__(self, point_count, tolerances, levels):
+        self.point_count = point_count
+        self.tolerances = tolerances
+        self.levels = levels
+
+    def get_points(self, cache, tolerance, ranges=None):
+        """ Get a PointCache of the points of the coarsest level that's no
+        coarser than tolerance, or the whole cache if there isn't one. If
+        ranges of points are given (see PointCache.get_ranges), only the
+        simplified points covering those are included.
+        """
+        chosen = None
+        for level, level_tolerance in enumerate(self.tolerances):
+            if level_tolerance <= tolerance:
+                chosen = level
+        if chosen is None:
+            if ranges is None:
+                return cache
+            return cache.get_ranges(ranges)
+        offsets, indexes = self.levels[chosen]
+        if ranges is None:
+            return cache.take(indexes, offsets)
+        pieces = []
+        for segment, start, end in ranges:
+            first, last = offsets[segment], offsets[segment + 1] - 1
+            # Reach out to the kept points either side of the range, so
+            # the simplified line covers all of it
+            low = np.searchsorted(indexes, start, side="right") - 1
+            high = np.searchsorted(indexes, end - 1, side="left")
+            pieces.append(indexes[max(low, first):min(high, last) + 1])
+        piece_offsets = np.cumsum([0] + [len(piece) for piece in pieces])
+        if pieces:
+            indexes = np.concatenate(pieces)
+        else:
+            indexes = np.zeros(0, dtype=np.int64)
+        return cache.take(indexes, piece_offsets)
+
+
+def build_lod(cache):
+    """ Work out every level of detail for a PointCache """
+    xs = np.asarray(cache.longitude)
+    ys = mercator_adjust_array(cache.latitude)
+    # Each level simplifies the points that the level before kept
+    kept = [np.arange(start, end) for start, end in
+            cache.get_segment_ranges()]
+    levels = []
+    for tolerance in LOD_TOLERANCES:
+        kept = [indexes[simplify(xs[indexes], ys[indexes], tolerance)]
+                for indexes in kept]
+        offsets = np.cumsum([0] + [len(indexes) for indexes in kept])
+        if kept:
+            indexes = np.concatenate(kept)
+        else:
+            indexes = np.zeros(0, dtype=np.int64)
+        levels.append((offsets.astype(np.int64), indexes.astype(np.int64)))
+    return LevelsOfDetail(cache.point_count, LOD_TOLERANCES, levels)
+
+
+def write_lod(lod, lod_path):
+    """ Write LevelsOfDetail to disk, via a temporary file like
+    pointcache.write_point_cache
+    """
+    tmp_path = "%s.%s.tmp" % (lod_path, os.getpid())
+    segment_count = len(lod.levels[0][0]) - 1 if lod.levels else 0
+    header = _HEADER.pack(_MAGIC, _VERSION, lod.point_count, segment_count,
+                          len(lod.levels))
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(lod.tolerances, dtype="<f8").tobytes())
+        for offsets, indexes in lod.levels:
+            f.write(np.asarray(offsets, dtype="<i8").tobytes())
+            f.write(np.asarray(indexes, dtype="<i8").tobytes())
+    os.replace(tmp_path, lod_path)
+
+
+def read_lod(lod_path):
+    """ Read LevelsOfDetail from disk """
+    with open(lod_path, "rb") as f:
+        raw = f.read()
+    if len(raw) < _HEADER.size:
+        raise LODError("Levels of detail %s are truncated" % lod_path)
+    magic, version, point_count, segment_count, level_count = \
+        _HEADER.unpack(raw[:_HEADER.size])
+    if magic != _MAGIC:
+        raise LODError("%s is not a levels of detail file" % lod_path)
+    if version != _VERSION:
+        msg = "Levels of detail %s are version %s, expected %s"
+        raise LODError(msg % (lod_path, version, _VERSION))
+    position = _HEADER.size
+    end = position + 8 * level_count
+    tolerances = np.frombuffer(raw[position:end], dtype="<f8")
+    tolerances = tuple(tolerances.tolist())
+    levels = []
+    for _ in range(level_count):
+        position, end = end, end + 8 * (segment_count + 1)
+        offsets = np.frombuffer(raw[position:end], dtype="<i8")
+        if len(offsets) != segment_count + 1:
+            raise LODError("Levels of detail %s are truncated" % lod_path)
+        position, end = end, end + 8 * int(offsets[-1])
+        indexes = np.frombuffer(raw[position:end], dtype="<i8")
+        if len(indexes) != offsets[-1]:
+            raise LODError("Levels of detail %s are truncated" % lod_path)
+        levels.append((offsets, indexes))
+    return LevelsOfDetail(point_count, tolerances, levels)
+
+
+def get_lod(gpx_path, cache, write=True):
+    """ Get the LevelsOfDetail for a gpx file (whose PointCache is cache),
+    using the file on disk if there's one that's up to date. If not, work
+    them out, and if write is True, save them for next time.
+    """
+    lod_path = get_lod_path(gpx_path)
+    if os.path.exists(lod_path):
+        try:
+            lod = read_lod(lod_path)
+        except LODError as e:
+            print("Rebuilding levels of detail: %s" % e)
+        else:
+            if lod.point_count == cache.point_count and \
+                    lod.tolerances == LOD_TOLERANCES:
+                return lod
+    lod = build_lod(cache)
+    if write:
+        write_lod(lod, lod_path)
+    return lod
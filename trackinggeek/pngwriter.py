@@ -0,0 +1,154 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Writing png files from cairo's pixels ourselves, so that we can choose
+the compression level, and so that the compression can happen in other
+threads while we carry on drawing.
+"""
+
+import os
+import struct
+import threading
+import zlib
+from queue import Queue
+
+import numpy as np
+
+DEFAULT_COMPRESSION = 6
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _chunk(kind, data):
+    checksum = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + kind + data + \
+        struct.pack(">I", checksum)
+
+
+def argb32_to_rgba(data, width, height, stride):
+    """ Convert cairo's ARGB32 pixels (native-endian, premultiplied by
+    alpha) into rows of straight RGBA bytes, rounding the same way cairo
+    does when it writes a png
+    """
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, stride)
+    pixels = pixels[:, :width * 4].reshape(height, width, 4)
+    if np.little_endian:
+        # In memory that's B, G, R, A
+        colours = pixels[:, :, 2::-1].astype(np.uint32)
+        alpha = pixels[:, :, 3].astype(np.uint32)
+    else:
+        colours = pixels[:, :, 1:].astype(np.uint32)
+        alpha = pixels[:, :, 0].astype(np.uint32)
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        straight = (colours * 255 + alpha[:, :, None] // 2) // \
+            alpha[:, :, None]
+    rgba[:, :, :3] = np.where(alpha[:, :, None] == 0, 0, straight)
+    rgba[:, :, 3] = alpha
+    return rgba
+
+
+def rgb_to_argb32(rgb):
+    """ Convert an array of rows of opaque (red, green, blue) colours, from
+    0 to 1, into cairo's ARGB32 pixels. Returns (data, stride), like
+    Canvas.get_image_data.
+    """
+    height, width = rgb.shape[:2]
+    rgb = np.rint(np.clip(rgb, 0.0, 1.0) * 255).astype(np.uint8)
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    if np.little_endian:
+        # B, G, R, A in memory
+        pixels[:, :, 2::-1] = rgb
+        pixels[:, :, 3] = 255
+    else:
+        pixels[:, :, 1:] = rgb
+        pixels[:, :, 0] = 255
+    return pixels.tobytes(), width * 4
+
+
+def write_png(path, data, width, height, stride,
+              compression=DEFAULT_COMPRESSION):
+    """ Write ARGB32 pixels (as given by Canvas.get_image_data) to a png
+    file, compressed with the given zlib level (0-9)
+    """
+    rgba = argb32_to_rgba(data, width, height, stride)
+    # Every row starts with a filter type, and we use none (0)
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    # zlib lets go of the GIL while it compresses, which is what makes
+    # writing from several threads worthwhile
+    image = zlib.compress(rows.tobytes(), compression)
+    tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(_SIGNATURE)
+        f.write(_chunk(b"IHDR", header))
+        f.write(_chunk(b"IDAT", image))
+        f.write(_chunk(b"IEND", b""))
+    os.replace(tmp_path, path)
+
+
+class PngWriter(object):
+    """ Writes png files in background threads. Frames are queued with
+    write(), which blocks while the queue is full, so that drawing can't
+    get more than a few frames ahead of the writing, and the frames
+    waiting in memory stay bounded.
+    """
+    def __init__(self, threads=None, compression=DEFAULT_COMPRESSION,
+                 queue_size=None):
+        if not threads:
+            threads = os.cpu_count() or 1
+        if queue_size is None:
+            queue_size = 2 * threads
+        self.compression = compression
+        self.queue = Queue(maxsize=queue_size)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            path, data, width, height, stride = job
+            try:
+                write_png(path, data, width, height, stride,
+                          self.compression)
+            except Exception as e:
+                self.errors.append((path, e))
+
+    def write(self, path, data, width, height, stride):
+        """ Queue a frame to be written to path """
+        if self.errors:
+            self._raise_error()
+        self.queue.put((path, data, width, height, stride))
+
+    def close(self):
+        """ Wait for everything queued to be written """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            self._raise_error()
+
+    def _raise_error(self):
+        path, e = self.errors[0]
+        raise IOError("Error writing %s: %s" % (path, e))
@@ -0,0 +1,243 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A binary cache of the points in a track, so that drawing doesn't have
+to parse the gpx xml every time.
+
+The file layout is a fixed header, followed by the segment offsets and then
+one column per value:
+  header:     magic, version, point count, segment count
+  offsets:    int64 * (segment count + 1)
+  latitude:   float64 * point count
+  longitude:  float64 * point count
+  elevation:  float64 * point count (NaN where missing)
+  time:       float64 * point count (unix seconds, NaN where missing)
+Everything is little-endian and eight byte aligned, so that the columns can
+be memory-mapped straight out of the file.
+"""
+
+import os
+import struct
+from array import array
+from datetime import timezone
+
+import numpy as np
+
+from trackinggeek.gpxstream import iter_points
+
+POINTCACHE_EXTENSION = ".points"
+
+_MAGIC = b"TGPC"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIQQ")
+_COLUMNS = ("latitude", "longitude", "elevation", "time")
+
+
+class PointCacheError(IOError):
+    pass
+
+
+def get_point_cache_path(gpx_path):
+    """ The point cache lives next to the gpx file it was made from. In the
+    vault, that means it is keyed by sha1 just like the gpx file.
+    """
+    return os.path.splitext(gpx_path)[0] + POINTCACHE_EXTENSION
+
+
+def _datetime_to_float(mytime):
+    if mytime is None:
+        return float("nan")
+    if mytime.tzinfo is None:
+        # Treat naive times as UTC, rather than whatever the local time
+        # zone happens to be
+        mytime = mytime.replace(tzinfo=timezone.utc)
+    return mytime.timestamp()
+
+
+class PointCache(object):
+    """ The points of a track, as one array per value. Segment i is made up
+    of the points from offsets[i] up to (but not including) offsets[i + 1].
+    """
+    def __init__(self, offsets, latitude, longitude, elevation, time):
+        self.offsets = offsets
+        self.latitude = latitude
+        self.longitude = longitude
+        self.elevation = elevation
+        self.time = time
+
+    @property
+    def point_count(self):
+        return len(self.latitude)
+
+    @property
+    def segment_count(self):
+        return len(self.offsets) - 1
+
+    def get_segment_ranges(self):
+        """ Get (start, end) index pairs for each segment """
+        offsets = [int(o) for o in self.offsets]
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def get_slice(self, start, end):
+        """ Get a PointCache (with a single segment) of the points from
+        start up to (but not including) end. Like get_segments, this is a
+        view on our arrays.
+        """
+        return PointCache(np.array([0, end - start]),
+                          self.latitude[start:end],
+                          self.longitude[start:end],
+                          self.elevation[start:end],
+                          self.time[start:end])
+
+    def take(self, indexes, offsets=None):
+        """ Get a PointCache of just the points at the given indexes, split
+        into segments at offsets (into indexes), or as a single segment if
+        offsets is None. Unlike get_slice, this copies the points.
+        """
+        if offsets is None:
+            offsets = np.array([0, len(indexes)])
+        return PointCache(offsets,
+                          self.latitude[indexes],
+                          self.longitude[indexes],
+                          self.elevation[indexes],
+                          self.time[indexes])
+
+    def get_ranges(self, ranges):
+        """ Get a PointCache of just the given (segment, start, end) ranges
+        of points (as TrackLibraryDB.get_point_ranges gives them), one
+        segment per range. This copies the points.
+        """
+        pieces = [np.arange(start, end) for _, start, end in ranges]
+        offsets = np.cumsum([0] + [len(piece) for piece in pieces])
+        if pieces:
+            indexes = np.concatenate(pieces)
+        else:
+            indexes = np.zeros(0, dtype=np.int64)
+        return self.take(indexes, offsets)
+
+    def get_segments(self):
+        """ Get a PointCache for each segment. These are views on our
+        arrays, so they don't copy (or, if mapped, read) any data.
+        """
+        return [self.get_slice(start, end)
+                for start, end in self.get_segment_ranges()]
+
+
+class PointCacheBuilder(object):
+    """ Collects the points of a gpx file (as iter_points gives them) into
+    a PointCache, so that they can be gathered while something else reads
+    them too (see record)
+    """
+    def __init__(self, gpx_path):
+        self.gpx_path = gpx_path
+        self.offsets = array("q", [0])
+        self.columns = dict((name, array("d")) for name in _COLUMNS)
+        self.current_number = None
+
+    def add(self, number, lat, lon, ele, time):
+        if number != self.current_number:
+            if self.current_number is not None:
+                self.offsets.append(len(self.columns["latitude"]))
+            self.current_number = number
+        self.columns["latitude"].append(lat)
+        self.columns["longitude"].append(lon)
+        self.columns["elevation"].append(float("nan") if ele is None
+                                         else ele)
+        self.columns["time"].append(_datetime_to_float(time))
+
+    def record(self, points):
+        """ Add each of the points as it goes past """
+        for point in points:
+            self.add(*point)
+            yield point
+
+    def get_cache(self):
+        if self.current_number is None:
+            raise ValueError("Track contains no points: %s" % self.gpx_path)
+        offsets = self.offsets + array("q", [len(self.columns["latitude"])])
+        arrays = [np.frombuffer(self.columns[name], dtype=np.float64)
+                  for name in _COLUMNS]
+        return PointCache(np.frombuffer(offsets, dtype=np.int64), *arrays)
+
+
+def build_point_cache(gpx_path):
+    """ Read the points out of a gpx file into a PointCache in memory """
+    builder = PointCacheBuilder(gpx_path)
+    for point in iter_points(gpx_path):
+        builder.add(*point)
+    return builder.get_cache()
+
+
+def write_point_cache(cache, cache_path):
+    """ Write a PointCache to disk. We write to a temporary file first so
+    that anything reading at the same time never sees half a file.
+    """
+    tmp_path = "%s.%s.tmp" % (cache_path, os.getpid())
+    header = _HEADER.pack(_MAGIC, _VERSION, cache.point_count,
+                          cache.segment_count)
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(cache.offsets, dtype="<i8").tobytes())
+        for name in _COLUMNS:
+            column = getattr(cache, name)
+            f.write(np.asarray(column, dtype="<f8").tobytes())
+    os.replace(tmp_path, cache_path)
+
+
+def read_point_cache(cache_path):
+    """ Memory-map a point cache file. Nothing is actually read from disk
+    until the arrays are used.
+    """
+    with open(cache_path, "rb") as f:
+        raw_header = f.read(_HEADER.size)
+    if len(raw_header) != _HEADER.size:
+        raise PointCacheError("Point cache %s is truncated" % cache_path)
+    magic, version, point_count, segment_count = _HEADER.unpack(raw_header)
+    if magic != _MAGIC:
+        raise PointCacheError("%s is not a point cache" % cache_path)
+    if version != _VERSION:
+        msg = "Point cache %s is version %s, expected %s"
+        raise PointCacheError(msg % (cache_path, version, _VERSION))
+    expected = _HEADER.size + 8 * (segment_count + 1 + 4 * point_count)
+    if os.path.getsize(cache_path) != expected:
+        raise PointCacheError("Point cache %s is truncated" % cache_path)
+
+    mapped = np.memmap(cache_path, dtype=np.uint8, mode="r")
+    position = _HEADER.size
+    end = position + 8 * (segment_count + 1)
+    offsets = mapped[position:end].view("<i8")
+    columns = []
+    for _ in _COLUMNS:
+        position, end = end, end + 8 * point_count
+        columns.append(mapped[position:end].view("<f8"))
+    return PointCache(offsets, *columns)
+
+
+def get_point_cache(gpx_path, write=True):
+    """ Get the PointCache for a gpx file, using the one on disk if there
+    is one. If there isn't (or it's unreadable), build it from the gpx, and
+    if write is True, save it for next time.
+    """
+    cache_path = get_point_cache_path(gpx_path)
+    if os.path.exists(cache_path):
+        try:
+            return read_point_cache(cache_path)
+        except PointCacheError as e:
+            print("Rebuilding point cache: %s" % e)
+    cache = build_point_cache(gpx_path)
+    if write:
+        write_point_cache(cache, cache_path)
+    return cache
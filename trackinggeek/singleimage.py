@@ -14,21 +14,70 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+from multiprocessing import Pool
+
 from trackinggeek.genericimageoutput import GenericImageOutput
 from trackinggeek.canvas import Canvas
 
+
+def split_by_points(tracks, parts):
+    """ Split a list of tracks into (at most) "parts" consecutive chunks,
+    each with roughly the same number of points to draw. The chunks keep
+    the tracks in order, so drawing them one after the other is the same
+    as drawing the whole list.
+    """
+    weights = [track.point_count or 1 for track in tracks]
+    total = float(sum(weights))
+    chunks = []
+    chunk = []
+    done = 0
+    for track, weight in zip(tracks, weights):
+        chunk.append(track)
+        done += weight
+        # Close this chunk once it's taken us past its share of the total
+        if done >= total * (len(chunks) + 1) / parts and \
+                len(chunks) < parts - 1:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _draw_partial(args):
+    """ Draw some tracks onto a transparent canvas in a worker process, and
+    send back the pixels
+    """
+    canvas_kwargs, tracks = args
+    canvas = Canvas(**canvas_kwargs)
+    canvas.draw_tracks(tracks)
+    data, stride = canvas.get_image_data()
+    return (data, stride, canvas.stroke_count, canvas.points_in,
+            canvas.points_drawn)
+
+
 class SingleImage(GenericImageOutput):
     def __init__(self, latitude_range=None, longitude_range=None,
                  elevation_range=None, speed_range=None,
-                 pixel_dimensions=None, config=None):
+                 pixel_dimensions=None, config=None, jobs=1):
+        """ jobs is the number of processes to draw png images with (0 for
+        one per cpu)
+        """
         GenericImageOutput.__init__(self, latitude_range=latitude_range,
                                     longitude_range=longitude_range,
                                     elevation_range=elevation_range,
                                     speed_range=speed_range,
                                     pixel_dimensions=pixel_dimensions,
                                     config=config)
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        self.jobs = jobs
 
-    def draw(self):
+    def draw(self, svg_path=None):
+        """ Draw the tracks onto a new canvas. If svg_path is given, the
+        canvas is an svg file there, otherwise it's an image in memory.
+        """
         self.prepare_to_draw()
         resolution = (self.pixel_width, self.pixel_height)
         latitude_range = (self.min_latitude, self.max_latitude)
@@ -36,23 +85,67 @@ class SingleImage(GenericImageOutput):
         elevation_range = (self.min_elevation, self.max_elevation)
         speed_range = (self.min_speed, self.max_speed)
         time_range = (self.start_time, self.end_time)
-        self.canvas = Canvas(resolution=resolution,
+        canvas_kwargs = dict(resolution=resolution,
                              latitude_range=latitude_range,
                              longitude_range=longitude_range,
                              speed_range=speed_range,
                              elevation_range=elevation_range,
                              time_range=time_range,
-                             config=self.config)
+                             config=self.config,
+                             settings=self.settings)
+        self.canvas = Canvas(svg_path=svg_path, **canvas_kwargs)
 
-        self.canvas.draw_tracks(self.tracks)
+        tracks = list(self.tracks)
+        # Heatmaps are coloured by the total over every track, so can't be
+        # drawn in pieces and laid on top of each other
+        if svg_path or self.jobs <= 1 or len(tracks) < 2 or \
+                self.settings.colour_type == "heatmap":
+            self.canvas.draw_tracks(tracks)
+            return
+        self._draw_in_parallel(tracks, canvas_kwargs)
+
+    def _draw_in_parallel(self, tracks, canvas_kwargs):
+        """ Split the tracks between worker processes. Each draws its share
+        onto its own transparent image, and we lay those over our canvas
+        in the order of the tracks, so the result doesn't depend on which
+        worker finishes first.
+        """
+        chunks = split_by_points(tracks, self.jobs)
+        print("Drawing %s tracks in %s processes" % (len(tracks),
+                                                     len(chunks)))
+        # The workers only need to draw the tracks, not the background
+        partial_kwargs = dict(canvas_kwargs)
+        partial_kwargs["config"] = None
+        partial_kwargs["settings"] = \
+            self.settings._replace(background=None)
+        work = [(partial_kwargs, chunk) for chunk in chunks]
+        pool = Pool(len(chunks))
+        try:
+            # imap gives us the results in order, and only as they're
+            # ready, so we don't hold every worker's image at once
+            for data, stride, strokes, points_in, points_drawn in \
+                    pool.imap(_draw_partial, work):
+                self.canvas.paint_image_data(data, stride)
+                self.canvas.stroke_count += strokes
+                self.canvas.points_in += points_in
+                self.canvas.points_drawn += points_drawn
+        finally:
+            pool.close()
+            pool.join()
+        print("Drew %s tracks with %s strokes (%s of %s points)" %
+              (len(tracks), self.canvas.stroke_count,
+               self.canvas.points_drawn, self.canvas.points_in))
 
     def save_png(self, path):
         """ Save the canvas as a png file
         """
         self.draw()
         print("Saving png: %s" % path)
-        self.canvas.surface.write_to_png(path)
+        self.canvas.save_png(path, self.config.get_png_compression())
 
     def save_svg(self, path):
-        #self.surface.finish()
-        raise NotImplementedError
+        """ Save the canvas as an svg file
+        """
+        print("Saving svg: %s" % path)
+        self.draw(svg_path=path)
+        self.canvas.finish()
@@ -0,0 +1,138 @@
+# Tracking Geek: A tool for visualizing swathes of gpx files at once
+# Copyright (C) 2012, Henry Bush
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" A grid over the world, for finding which parts of which tracks pass
+through a region, without looking at the tracks that merely have it in
+their bounding box.
+
+Each segment of a track is split into chunks of consecutive points: a new
+chunk starts whenever the points move into another grid cell (or the
+chunk gets too long). Each chunk also includes the first point of the
+next, so that no pair of points falls between two chunks. A chunk is filed
+under every cell its bounding box touches, apart from the few (e.g. across
+gaps in the recording) that touch so many cells that they're filed under
+WIDE_CELL instead, which every query looks in.
+"""
+
+import math
+
+import numpy as np
+
+# The size of a cell, in degrees of latitude and longitude (about 1km)
+GRID_CELL_SIZE = 0.01
+# The cell that chunks too big to file under every cell they touch go in
+WIDE_CELL = -1
+
+_GRID_COLUMNS = int(math.ceil(360 / GRID_CELL_SIZE))
+# The most points in a chunk
+_CHUNK_POINTS = 256
+# The most cells a chunk is filed under, before it's filed as wide
+_MAX_CHUNK_CELLS = 16
+# The most rows of cells a query will look up, before it's quicker to just
+# check every chunk's bounding box (this also keeps us well inside sqlite's
+# limit on the number of variables in a query)
+_MAX_QUERY_ROWS = 256
+
+
+def _get_row(latitude):
+    return int(math.floor((latitude + 90) / GRID_CELL_SIZE))
+
+
+def _get_column(longitude):
+    # 180 degrees is in the last column, not one past it (which would be
+    # the first cell of the next row)
+    return min(int(math.floor((longitude + 180) / GRID_CELL_SIZE)),
+               _GRID_COLUMNS - 1)
+
+
+def get_chunks(points):
+    """ Split the points of a track (a PointCache) into chunks. Returns a
+    list of
+      (segment, start, end, min_latitude, max_latitude, min_longitude,
+       max_longitude)
+    where the chunk is the points from start up to (but not including) end
+    """
+    lats = np.asarray(points.latitude)
+    lons = np.asarray(points.longitude)
+    chunks = []
+    for segment, (start, end) in enumerate(points.get_segment_ranges()):
+        seg_lats, seg_lons = lats[start:end], lons[start:end]
+        rows = np.floor((seg_lats + 90) / GRID_CELL_SIZE).astype(np.int64)
+        columns = np.minimum(np.floor((seg_lons + 180) / GRID_CELL_SIZE),
+                             _GRID_COLUMNS - 1)
+        cells = rows * _GRID_COLUMNS + columns.astype(np.int64)
+        count = end - start
+        changes = np.flatnonzero(cells[1:] != cells[:-1]) + 1
+        starts = np.unique(np.concatenate((changes, np.arange(
+            0, count, _CHUNK_POINTS))))
+        # Each chunk goes up to and including the first point of the next
+        ends = np.minimum(np.append(starts[1:] + 1, count), count)
+        bounds = []
+        for values in (seg_lats, seg_lons):
+            lows = np.minimum.reduceat(values, starts)
+            highs = np.maximum.reduceat(values, starts)
+            following = values[ends - 1]
+            bounds.append(np.minimum(lows, following))
+            bounds.append(np.maximum(highs, following))
+        for chunk in zip((starts + start).tolist(), (ends + start).tolist(),
+                         *[b.tolist() for b in bounds]):
+            chunks.append((segment,) + chunk)
+    return chunks
+
+
+def get_chunk_cells(min_latitude, max_latitude, min_longitude,
+                    max_longitude):
+    """ Get the cells that a chunk with the given bounds is filed under """
+    first_row, last_row = _get_row(min_latitude), _get_row(max_latitude)
+    first_column = _get_column(min_longitude)
+    last_column = _get_column(max_longitude)
+    if (last_row - first_row + 1) * (last_column - first_column + 1) > \
+            _MAX_CHUNK_CELLS:
+        return [WIDE_CELL]
+    return [row * _GRID_COLUMNS + column
+            for row in range(first_row, last_row + 1)
+            for column in range(first_column, last_column + 1)]
+
+
+def get_region_cells(min_latitude, max_latitude, min_longitude,
+                     max_longitude):
+    """ Get the cells that cover a region, as a (first, last) range of
+    cells for each row of the grid. Returns None if the region covers so
+    much of the grid that it isn't worth looking up cell by cell.
+    """
+    first_row = _get_row(max(min_latitude, -90.0))
+    last_row = _get_row(min(max_latitude, 90.0))
+    if last_row - first_row + 1 > _MAX_QUERY_ROWS:
+        return None
+    first_column = _get_column(max(min_longitude, -180.0))
+    last_column = _get_column(min(max_longitude, 180.0))
+    return [(row * _GRID_COLUMNS + first_column,
+             row * _GRID_COLUMNS + last_column)
+            for row in range(first_row, last_row + 1)]
+
+
+def merge_ranges(ranges):
+    """ Merge (segment, start, end) point ranges that overlap or touch,
+    and sort them
+    """
+    merged = []
+    for segment, start, end in sorted(ranges):
+        if merged and merged[-1][0] == segment and merged[-1][2] >= start:
+            if end > merged[-1][2]:
+                merged[-1] = (segment, merged[-1][1], end)
+            continue
+        merged.append((segment, start, end))
+    return merged
@@ -14,11 +14,62 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from copy import deepcopy
+import numpy as np
+
 from trackinggeek.genericimageoutput import GenericImageOutput
-from trackinggeek.canvas import Canvas
+from trackinggeek.canvas import Canvas, get_start_time
+from trackinggeek.colour import lookup_colours
+from trackinggeek.pngwriter import (DEFAULT_COMPRESSION, PngWriter,
+                                   rgb_to_argb32)
 from trackinggeek.util import add_num_to_path
-from trackinggeek.tracklibrary import OldTrackLibrary
+
+
+def time_bucket(mytime, unit):
+    """ Number the day, week, month or year that mytime falls in, so that
+    consecutive periods get consecutive numbers. Weeks start on a Monday.
+    """
+    if unit == "day":
+        return mytime.toordinal()
+    if unit == "week":
+        # Day 1 (1st January of year 1) was a Monday
+        return (mytime.toordinal() - 1) // 7
+    if unit == "month":
+        return mytime.year * 12 + mytime.month - 1
+    if unit == "year":
+        return mytime.year
+    raise ValueError("Not a unit of time: %s" % unit)
+
+
+class FadingTrail(object):
+    """ The brightness of a fading timelapse. Each frame, what's there
+    already is dimmed by the fade factor and the new tracks are added on
+    top, so a frame costs the same however many tracks came before it.
+    """
+    def __init__(self, width, height, fade, palette_table, background=None):
+        self.width = width
+        self.height = height
+        self.fade = fade
+        self.palette_table = palette_table
+        self.background = np.array(background or (0.0, 0.0, 0.0),
+                                   dtype=np.float32)[:3]
+        self.buffer = np.zeros((height, width), dtype=np.float32)
+
+    def add(self, coverage):
+        """ Move on a frame, adding the coverage of its new tracks (see
+        Canvas.get_coverage)
+        """
+        self.buffer *= self.fade
+        self.buffer += coverage
+
+    def get_image_data(self):
+        """ Colour the brightness with the palette, over the background,
+        giving opaque pixels in the same form as Canvas.get_image_data
+        """
+        brightness = np.minimum(self.buffer, 1.0)
+        colours = lookup_colours(self.palette_table, brightness)
+        brightness = brightness[:, :, None]
+        rgb = self.background * (1 - brightness) + colours * brightness
+        return rgb_to_argb32(rgb)
 
 
 class Timelapse(GenericImageOutput):
@@ -32,8 +83,8 @@ class Timelapse(GenericImageOutput):
                                     pixel_dimensions=pixel_dimensions,
                                     config=config)
         self._frames_prepared = False
-        self.timelapse_unit = config.get_timelapse_unit()
-        self.units_per_frame = config.get_units_per_frame()
+        self.timelapse_unit = self.settings.timelapse_unit
+        self.units_per_frame = self.settings.units_per_frame
 
     def draw(self):
         self.prepare_to_draw()
@@ -42,84 +93,245 @@ class Timelapse(GenericImageOutput):
         self.longitude_range = (self.min_longitude, self.max_longitude)
         self.speed_range = (self.min_speed, self.max_speed)
         self.elevation_range = (self.min_elevation, self.max_elevation)
+        self.time_range = (self.start_time, self.end_time)
         self._prepare_frames()
 
     def save_png(self, path):
-        """ Save the canvas as a png file
+        """ Save each frame as a numbered png file. The files are written
+        by background threads while we draw the next frames.
         """
         self.draw()
-        counter = 0
-        for f in self.frames:
-            counter += 1
-            print("Drawing frame %s/%s" % (counter, len(self.frames)))
-            f.draw()
-            num_path = add_num_to_path(path, f.frame_number)
-            print("Writing png: %s" % (num_path,))
-            f.canvas.surface.write_to_png(num_path)
-            f.clear()
+        compression = self.config.get_png_compression()
+        if compression is None:
+            compression = DEFAULT_COMPRESSION
+        writer = PngWriter(threads=self.config.get_png_writers(),
+                           compression=compression)
+        if self.settings.timelapse_fade is None:
+            frames = self._iter_frame_images()
+        else:
+            frames = self._iter_faded_frame_images()
+        try:
+            for frame_number, data, stride in frames:
+                num_path = add_num_to_path(path, frame_number)
+                print("Writing png: %s" % (num_path,))
+                writer.write(num_path, data, int(self.pixel_width),
+                             int(self.pixel_height), stride)
+        finally:
+            writer.close()
+
+    def _iter_frame_images(self):
+        """ Yield (frame_number, data, stride) with the pixels of each
+        frame, as given by Canvas.get_image_data
+        """
+        for frame_number, canvas in self.iter_frames():
+            # The canvas carries on being drawn on, so this is a copy of
+            # how it looks now
+            data, stride = canvas.get_image_data()
+            yield frame_number, data, stride
+
+    def _iter_faded_frame_images(self):
+        """ Like _iter_frame_images, but older tracks fade away. The canvas
+        is cleared after every frame, so it only ever has that frame's new
+        tracks on it, and those are added to a FadingTrail.
+        """
+        canvas = self._get_canvas(
+            0, settings=self.settings._replace(background=None))
+        trail = FadingTrail(int(self.pixel_width), int(self.pixel_height),
+                            self.settings.timelapse_fade,
+                            self.settings.palette_table,
+                            self.settings.background)
+        for frame_number, canvas in self.iter_frames(canvas):
+            trail.add(canvas.get_coverage())
+            canvas.clear()
+            data, stride = trail.get_image_data()
+            yield frame_number, data, stride
 
     def save_svg(self, path):
-        # self.surface.finish()
-        raise NotImplementedError
+        """ Save each frame as a numbered svg file. Unlike the pngs, every
+        svg has to contain all of the tracks so far, so each frame is
+        drawn from scratch.
+        """
+        self.draw()
+        if self.timelapse_unit == "pointtime":
+            raise NotImplementedError("svg output isn't supported for "
+                                      "pointtime timelapses")
+        if self.settings.timelapse_fade is not None:
+            raise NotImplementedError("svg output isn't supported for "
+                                      "fading timelapses")
+        total = len(self.frame_ends)
+        for frame_number, end in enumerate(self.frame_ends):
+            num_path = add_num_to_path(path, frame_number)
+            print("Drawing frame %s/%s to %s" % (frame_number + 1, total,
+                                                 num_path))
+            canvas = self._get_canvas(frame_number, svg_path=num_path)
+            canvas.draw_tracks(self.sorted_tracks[:end])
+            canvas.finish()
+
+    def iter_frames(self, canvas=None):
+        """ Draw the frames one after another onto a single canvas, and
+        yield (frame_number, canvas) once each frame is ready. Each frame
+        only draws the tracks that are new since the one before, so the
+        whole timelapse costs about the same as drawing every track once.
+        The canvas is drawn on again as soon as we move on, so save it
+        before asking for the next frame. If no canvas is given, we make
+        one with our settings.
+        """
+        if canvas is None:
+            canvas = self._get_canvas(0)
+        if self.timelapse_unit == "pointtime":
+            for frame in self._iter_point_frames(canvas):
+                yield frame
+            return
+        total = len(self.frame_ends)
+        start = 0
+        for frame_number, end in enumerate(self.frame_ends):
+            print("Drawing frame %s/%s" % (frame_number + 1, total))
+            # Periods with no new tracks just repeat the previous frame
+            if end > start:
+                canvas.draw_tracks(self.sorted_tracks[start:end])
+            start = end
+            yield frame_number, canvas
 
-    def _get_canvas(self, frame_number):
+    def _iter_point_frames(self, canvas):
+        """ Like iter_frames, but each frame adds the points recorded in
+        the next interval of time, so tracks appear point by point. Every
+        segment remembers how far it has been drawn, and a binary search
+        of its times finds where this frame gets up to, so each point is
+        only drawn once over the whole timelapse. Intervals with nothing
+        recorded don't get a frame (see _prepare_point_frames).
+        """
+        tracks = self.point_tracks
+        next_track = 0
+        # Each entry is [segment, points drawn so far, last point time,
+        # start time (see get_start_time)]
+        active = []
+        total = len(self.frame_times)
+        for frame_number, frame_end in enumerate(self.frame_times):
+            print("Drawing frame %s/%s" % (frame_number + 1, total))
+            # Pick up the tracks that start before the end of this frame
+            while next_track < len(tracks) and \
+                    tracks[next_track][0] < frame_end:
+                points = tracks[next_track][1].get_points()
+                for segment in points.get_segments():
+                    times = segment.time[~np.isnan(segment.time)]
+                    if len(times):
+                        active.append([segment, 0, times.max(),
+                                       get_start_time(segment, 0)])
+                next_track += 1
+
+            still_active = []
+            for entry in active:
+                segment, drawn, last_time, start_time = entry
+                end = int(np.searchsorted(segment.time, frame_end,
+                                          side="left"))
+                # Start from the last point we drew, so that the line
+                # carries on from where the last frame left it
+                start = max(drawn - 1, 0)
+                if end - start >= 2:
+                    canvas.draw_segment(segment.get_slice(start, end),
+                                        start_time)
+                entry[1] = max(drawn, end)
+                if last_time >= frame_end:
+                    still_active.append(entry)
+            active = still_active
+            canvas.flush()
+            yield frame_number, canvas
+
+    def _get_canvas(self, frame_number, svg_path=None, settings=None):
+        if settings is None:
+            settings = self.settings
         return Canvas(resolution=self.resolution,
                       latitude_range=self.latitude_range,
                       longitude_range=self.longitude_range,
                       speed_range=self.speed_range,
                       elevation_range=self.elevation_range,
                       time_range=self.time_range,
-                      config=self.config)
+                      config=self.config,
+                      settings=settings,
+                      svg_path=svg_path)
 
     def _prepare_frames(self):
+        """ Work out which tracks appear in each frame. Frames only ever
+        add tracks, so we just keep the tracks in the order they appear,
+        and for each frame, how many of them it shows.
+        """
         if self._frames_prepared:
             return
-        tl = OldTrackLibrary()
         # TODO: We might want to do some cleverer sorting
         print("Sorting tracks by time...")
-        tracks = [t for t in tl.sort_tracks_by_time() if t in self.tracks]
+        self.sorted_tracks = sorted(self.tracks, key=lambda t: t.min_time)
         print("Sorted")
-        self.frames = []
+        if self.timelapse_unit == "pointtime":
+            self._prepare_point_frames()
+            self._frames_prepared = True
+            return
         if self.timelapse_unit == "track":
             batchsize = self.units_per_frame
-            # This splits a list into batches, ie
-            # [1,2,3,4,5] -> [[1,2],[3,4],[5]]
-            cumulative_tracks = []
-            counter = 0
-            print("Creating frames")
-            startnums = range(0, len(tracks), batchsize)
-            # The end number should be 1 more than might be expected,
-            # because of the way python list slicing works
-            batches = [(s, s + batchsize) for s in startnums]
-            total = len(batches)
-            for tracklist in (tracks[s:e] for (s, e) in batches):
-                counter += 1
-                if counter % 100 == 0 and total > 200:
-                    print("\tCreated %s/%s frames" % (counter, total))
-                cumulative_tracks.extend(tracklist)
-                canvas = self._get_canvas(counter - 1)
-                self.frames.append(Frame(canvas=canvas,
-                                         tracks=deepcopy(cumulative_tracks),
-                                         frame_number=counter-1))
+            total = len(self.sorted_tracks)
+            # The end of each batch, ie [1,2,3,4,5] -> [[1,2],[3,4],[5]]
+            # gives [2, 4, 5]
+            self.frame_ends = [min(s + batchsize, total)
+                               for s in range(0, total, batchsize)]
         else:
-            raise NotImplementedError("Don't know how to handle %s" %
-                                      self.timelapse_unit)
+            self.frame_ends = self._get_period_frame_ends()
+        print("Created %s frames" % len(self.frame_ends))
         self._frames_prepared = True
 
+    def _prepare_point_frames(self):
+        """ Work out when each frame of a pointtime timelapse ends. Frames
+        go an interval at a time from the first recorded point to the
+        last, but intervals when no track was being recorded (e.g. between
+        trips) are left out, rather than repeating the frame before.
+        """
+        self.frame_times = []
+        self.point_tracks = []
+        # When each track was recorded comes from its points, rather than
+        # min_time and max_time, which the library gives in local time
+        recorded = []
+        for track in self.sorted_tracks:
+            times = track.get_points().time
+            times = times[~np.isnan(times)]
+            if len(times):
+                recorded.append((float(times.min()), float(times.max()),
+                                 track))
+        if not recorded:
+            return
+        recorded.sort(key=lambda r: r[0])
+        # (start time, track), in the order the tracks start
+        self.point_tracks = [(start, track) for start, _, track in recorded]
+        first_time = recorded[0][0]
+        interval = self.settings.timelapse_interval
+        # The [first, last] intervals (counting from the first point) that
+        # each track was recorded in, merged where the tracks overlap
+        spans = []
+        for start_time, end_time, _ in recorded:
+            start = int((start_time - first_time) // interval)
+            end = int((end_time - first_time) // interval)
+            if spans and start <= spans[-1][1] + 1:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        self.frame_times = [first_time + (i + 1) * interval
+                            for start, end in spans
+                            for i in range(start, end + 1)]
+        skipped = spans[-1][1] + 1 - len(self.frame_times)
+        print("Created %s frames of %s seconds, skipping %s with nothing "
+              "recorded" % (len(self.frame_times), interval, skipped))
 
-class Frame(object):
-    def __init__(self, canvas, tracks, frame_number):
-        self.canvas = canvas
-        # Let's keep this. We might want to postpone the track parsing
-        # in future
-        self.tracks = tracks
-        self.frame_number = frame_number
-
-    def draw(self):
-        if not self.canvas:
-            raise RuntimeError("This frame has already been cleared!")
-        self.canvas.draw_tracks(self.tracks)
-
-    def clear(self):
-        # This is to save memory when we're done with it
-        self.canvas = None
+    def _get_period_frame_ends(self):
+        """ Get the frame ends for a calendar unit, with each frame adding
+        units_per_frame days / weeks / etc. from the start of the first
+        track onwards. Periods without any tracks still get their frames.
+        """
+        if not self.sorted_tracks:
+            return []
+        unit = self.timelapse_unit
+        # The tracks are in order of start time, so this is in order too
+        buckets = np.array([time_bucket(t.min_time, unit)
+                            for t in self.sorted_tracks])
+        first = buckets[0]
+        # Frame i shows everything before period first + (i+1) * units
+        limits = np.arange(first + self.units_per_frame,
+                           buckets[-1] + self.units_per_frame + 1,
+                           self.units_per_frame)
+        return np.searchsorted(buckets, limits, side="left").tolist()
@@ -19,6 +19,10 @@ import os.path
 import hashlib
 from datetime import datetime
 
+from trackinggeek.gpxstream import extract_stats
+from trackinggeek.lod import get_lod
+from trackinggeek.pointcache import get_point_cache
+
 BUF_SIZE = 65536
 
 
@@ -28,7 +32,8 @@ _TRACK_ATTRIBUTES = {"path": str, "sha1": str,
                      "min_latitude": float, "max_latitude": float,
                      "min_longitude": float, "max_longitude": float,
                      "min_speed": float, "max_speed": float,
-                     "min_time": datetime, "max_time": datetime}
+                     "min_time": datetime, "max_time": datetime,
+                     "point_count": int, "segment_count": int}
 
 
 def get_track(path):
@@ -48,6 +53,14 @@ class TrackError(IOError):
 
 
 class Track(object):
+    # Whether to save the point cache next to the gpx file. We don't want
+    # to litter the user's own directories with them, so only do it in the
+    # vault.
+    _write_point_cache = False
+    # The (segment, start, end) ranges of points to draw, if not all of
+    # them (see TrackLibraryDB.get_tracks_in_region)
+    point_ranges = None
+
     def __init__(self):
         raise NotImplementedError("Please use the subclasses")
 
@@ -81,6 +94,47 @@ class Track(object):
         self._parsed_track = self.get_parsed(force=True)
         return self._parsed_track
 
+    def get_points(self):
+        """ Get all the points in the track as a PointCache. This comes from
+        the binary cache next to the gpx file where possible, so that we
+        don't have to parse the xml again.
+        """
+        if self.save_memory:
+            return self._load_points()
+        try:
+            return self._points
+        except (KeyError, AttributeError):
+            pass
+        self._points = self._load_points()
+        return self._points
+
+    def _load_points(self):
+        return get_point_cache(self._get_filepath(),
+                               write=self._write_point_cache)
+
+    def get_simplified_points(self, tolerance, ranges=None):
+        """ Get the points of the track, simplified as far as the levels of
+        detail allow without moving the line more than tolerance (in
+        degrees, see lod.py). Gives all the points if there's no level
+        that fine. If ranges are given (see point_ranges), only the points
+        covering those are included.
+        """
+        points = self.get_points()
+        try:
+            lod = self._lod
+        except (KeyError, AttributeError):
+            lod = self._load_lod(points)
+            # If there's no file to read them back from, keep them even
+            # when saving memory, since they're much smaller than the
+            # points and slow to work out again
+            if not self.save_memory or not self._write_point_cache:
+                self._lod = lod
+        return lod.get_points(points, tolerance, ranges)
+
+    def _load_lod(self, points):
+        return get_lod(self._get_filepath(), points,
+                       write=self._write_point_cache)
+
     def get_segments(self):
         segments = []
         for track in self.get_parsed().tracks:
@@ -102,6 +156,9 @@ class Track(object):
         self._max_speed = parsed.get_moving_data().max_speed
         self._length_2d = parsed.length_2d()
         self._length_3d = parsed.length_3d()
+        self._point_count = parsed.get_points_no()
+        self._segment_count = len([s for s in self.get_segments()
+                                   if s.points])
 
     def __getattr__(self, name):
         valid_attrs = _TRACK_ATTRIBUTES.keys()
@@ -155,6 +212,8 @@ class Track(object):
 
 
 class TrackDB(Track):
+    _write_point_cache = True
+
     def __init__(self, data, save_memory=False):
         """ Instantiate a track object using the data retrieved from the
         database. Note that the "path" in the database isn't the actual path to
@@ -175,6 +234,64 @@ class TrackDB(Track):
         return self.path
 
 
+class TrackRecord(object):
+    """ A track as read from the database. Each column is a plain slotted
+    attribute, so these are small and quick to read, which matters when
+    we have the whole library in memory. Anything that needs the points
+    goes through a full TrackDB, which is made each time it's needed and
+    not kept, so that drawing the library doesn't leave every track's
+    point cache mapped (and a file open for each).
+    """
+    __slots__ = tuple(sorted(_TRACK_ATTRIBUTES)) + ("save_memory",
+                                                    "point_ranges")
+
+    def __init__(self, data, save_memory=False):
+        for key in _TRACK_ATTRIBUTES:
+            setattr(self, key, data.get(key))
+        self.save_memory = save_memory
+        # See Track.point_ranges
+        self.point_ranges = None
+
+    def __hash__(self):
+        return hash(self.sha1)
+
+    def __repr__(self):
+        return "trackinggeek.TrackRecord(sha1=%s, path=%s)" % (self.sha1,
+                                                               self.path)
+
+    @property
+    def min_date(self):
+        return self.min_time.date()
+
+    @property
+    def max_date(self):
+        return self.max_time.date()
+
+    @property
+    def length(self):
+        """ Get the length of the track. This gets the 3D length. To get the
+        flat length (as measured on a map), use length_2d.
+        """
+        return self.length_3d
+
+    def get_track(self):
+        """ Get a full TrackDB for this record """
+        data = dict((key, getattr(self, key)) for key in _TRACK_ATTRIBUTES)
+        return TrackDB(data, save_memory=self.save_memory)
+
+    def get_parsed(self, force=False):
+        return self.get_track().get_parsed(force=force)
+
+    def get_points(self):
+        return self.get_track().get_points()
+
+    def get_simplified_points(self, tolerance, ranges=None):
+        return self.get_track().get_simplified_points(tolerance, ranges)
+
+    def get_segments(self):
+        return self.get_track().get_segments()
+
+
 class TrackPath(Track):
     def __init__(self, path, save_memory=False):
         # TODO: ability to give it a vault path, and it detect it as such
@@ -183,3 +300,14 @@ class TrackPath(Track):
             raise IOError(msg)
         self.save_memory = save_memory
         self.path = path
+
+    def _extract_stats_from_gpx(self):
+        """ Stream through the file rather than building the whole gpxpy
+        tree, since we only need to see each point once to get the stats.
+        """
+        stats = extract_stats(self._get_filepath())
+        if stats["min_latitude"] is None:
+            msg = "Bounds are None. Invalid track? %s"
+            raise ValueError(msg % self._get_filepath())
+        for key, value in stats.items():
+            setattr(self, "_%s" % key, value)
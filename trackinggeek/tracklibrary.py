@@ -1,15 +1,40 @@
 import re
 import os
 import sqlite3
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
 from datetime import date, datetime, timedelta, timezone
-from trackinggeek.track import (TrackPath, TrackError, TrackDB,
+from trackinggeek.track import (TrackPath, TrackError, TrackRecord,
                                 _TRACK_ATTRIBUTES)
+from trackinggeek.gpxstream import extract_stats, iter_points
+from trackinggeek.lod import get_lod
+from trackinggeek.pointcache import (PointCacheBuilder, get_point_cache,
+                                     get_point_cache_path, write_point_cache)
+from trackinggeek.spatialgrid import (WIDE_CELL, get_chunk_cells, get_chunks,
+                                      get_region_cells, merge_ranges)
 from trackinggeek.util import tracks_from_path
 
 _TYPE_LOOKUP = {str: "STRING", int: "INTEGER", float: "FLOAT",
                 date: "INTEGER", datetime: "INTEGER", timedelta: "INTEGER",
                 bool: "BOOLEAN"}
 
+# The version of the database layout that this code creates. Older
+# databases are brought up to date by TrackLibraryDB.migrate
+SCHEMA_VERSION = 7
+
+# The columns of the track table that make up its bounding box. These are
+# also the columns of the spatial index.
+_SPATIAL_COLUMNS = ("min_latitude", "max_latitude",
+                    "min_longitude", "max_longitude")
+
+# How many tracks to read from the database at once in iter_tracks
+_FETCH_BATCH_SIZE = 1000
+
+# How many new tracks to write to the database at once when adding a
+# directory
+_INSERT_BATCH_SIZE = 500
+
 # This creates a translation table whereby each of these characters
 # translates to nothing
 _SQL_CHECK = str.maketrans(dict.fromkeys(")(][;,"))
@@ -83,12 +108,53 @@ def get_relative_vault_path(track):
     return (dirname, basename)
 
 
+def _hash_track(path):
+    """ Get the sha1 of a gpx file. This is run in the worker processes of
+    add_track_directory, so it reports errors rather than raising them.
+    """
+    try:
+        return path, TrackPath(path).sha1, None
+    except Exception as e:
+        return path, None, "%s: %s" % (e.__class__.__name__, e)
+
+
+def _scan_track(path_and_sha1):
+    """ Get everything we store in the database about a gpx file (given
+    with the sha1 that _hash_track found), and save its point cache and
+    levels of detail. The stats and the point cache come from the same
+    pass over the file. Like _hash_track, this is run in the worker
+    processes, so errors are returned, not raised.
+    """
+    path, sha1 = path_and_sha1
+    try:
+        builder = PointCacheBuilder(path)
+        data = extract_stats(path, builder.record(iter_points(path)))
+        data["path"] = path
+        data["sha1"] = sha1
+        # Check this here, like _get_track_row would, so that one bad file
+        # is reported with the others rather than stopping the whole batch
+        missing = sorted(c for c, value in data.items() if value is None)
+        if missing:
+            raise ValueError("Track has None values (%s)" %
+                             ", ".join(missing))
+        cache = builder.get_cache()
+        write_point_cache(cache, get_point_cache_path(path))
+        get_lod(path, cache)
+        return path, data, None
+    except Exception as e:
+        return path, None, "%s: %s" % (e.__class__.__name__, e)
+
+
 class TrackLibraryDB(object):
     """ Information about all the tracks, stored in an sqlite database """
     global_table = "global"
     track_table = "track"
+    manifest_table = "manifest"
+    spatial_index = "track_rtree"
+    grid_table = "track_grid"
 
-    def __init__(self, library_dir=None, db_path=None, debug=False):
+    def __init__(self, library_dir=None, db_path=None, debug=False,
+                 save_memory=False):
         # If we get given a path, use it, but we can make up our own
         if db_path is None:
             if library_dir is None:
@@ -105,9 +171,17 @@ class TrackLibraryDB(object):
             self._dbpath = os.path.realpath(db_path)
             self.library_dir = None
         self._debug = debug
+        # Passed on to the TrackRecords we give out
+        self.save_memory = save_memory
+        self._transaction_depth = 0
+        self._spatial_index_present = None
         self._connect_db()
         if self.library_dir is None:
             self.update_library_dir_from_database()
+        if self.is_present():
+            self.migrate()
+            index = _check(self.spatial_index)
+            self._spatial_index_present = self._table_exists(index)
         self.library_dir = os.path.realpath(self.library_dir)
         if not os.path.isdir(self.library_dir):
             msg = "Library directory %s doesn't exist"
@@ -120,7 +194,8 @@ class TrackLibraryDB(object):
             tmp_dict["min_time"] = _int_to_datetime(tmp_dict["min_time"])
             tmp_dict["max_time"] = _int_to_datetime(tmp_dict["max_time"])
             tmp_dict["path"] = os.path.join(self.library_dir, tmp_dict["path"])
-            track_object = TrackDB(tmp_dict)
+            track_object = TrackRecord(tmp_dict,
+                                       save_memory=self.save_memory)
             return track_object
         except:
             print("Error parsing: %s" % (raw_tuple,))
@@ -148,9 +223,41 @@ class TrackLibraryDB(object):
                 variables = [variables]
             self.debug("Variables: %s" % (variables,))
             return_value = self._cursor.execute(sql, variables)
-        self._conn.commit()
+        if not self._transaction_depth:
+            self._conn.commit()
         return return_value
 
+    def _executemany(self, sql, rows):
+        """ Execute an sql statement once for each row of variables. Use
+        this inside a transaction, so that it is committed all at once.
+        """
+        self.debug("Executing many:")
+        self.debug(sql)
+        return self._cursor.executemany(sql, rows)
+
+    @contextmanager
+    def transaction(self):
+        """ Group statements so that they're committed (or, if there's an
+        exception, rolled back) together, rather than one at a time. These
+        can be nested: only the outermost one commits.
+        """
+        if not self._transaction_depth and not self._conn.in_transaction:
+            # Begin explicitly, since sqlite3 only does so itself before
+            # data changes, and we want schema changes included too
+            self._cursor.execute("BEGIN")
+        self._transaction_depth += 1
+        try:
+            yield self
+        except:
+            # We can do a bare except, as we're re-raising
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._conn.rollback()
+            raise
+        self._transaction_depth -= 1
+        if not self._transaction_depth:
+            self._conn.commit()
+
     def is_present(self):
         sql = "SELECT name FROM sqlite_master WHERE type='table'"
         self._execute(sql)
@@ -176,6 +283,153 @@ class TrackLibraryDB(object):
         self.library_dir = raw_tuple[0]
         return self.library_dir
 
+    def get_schema_version(self):
+        """ Get the version of the database layout. Databases from before we
+        kept track of this are version 1.
+        """
+        sql = 'SELECT value FROM %s WHERE parameter = "schema_version"'
+        self._execute(sql % _check(self.global_table))
+        raw_tuple = self._cursor.fetchone()
+        if raw_tuple is None:
+            return 1
+        return int(raw_tuple[0])
+
+    def _set_schema_version(self, version):
+        table_name = _check(self.global_table)
+        sql = 'DELETE FROM %s WHERE parameter = "schema_version"'
+        self._execute(sql % table_name)
+        sql = "INSERT INTO %s (parameter, value) VALUES ('schema_version', ?)"
+        self._execute(sql % table_name, str(version))
+
+    def migrate(self):
+        """ Update an existing database, in place, to SCHEMA_VERSION """
+        version = self.get_schema_version()
+        if version > SCHEMA_VERSION:
+            msg = "Database %s is version %s, but we only understand up to %s"
+            raise RuntimeError(msg % (self._dbpath, version, SCHEMA_VERSION))
+        while version < SCHEMA_VERSION:
+            version += 1
+            print("Updating %s to version %s" % (self._dbpath, version))
+            # Slow work that doesn't change the database, like reading
+            # every track, is done first, so that the transaction (and the
+            # lock on the database) isn't held for all of it
+            arguments = ()
+            prepare = getattr(self, "_prepare_migration_to_%s" % version,
+                              None)
+            if prepare is not None:
+                arguments = (prepare(),)
+            with self.transaction():
+                getattr(self, "_migrate_to_%s" % version)(*arguments)
+                self._set_schema_version(version)
+
+    def _migrate_to_2(self):
+        self._create_manifest_table()
+
+    def _migrate_to_3(self):
+        self._create_spatial_index()
+
+    def _prepare_migration_to_4(self):
+        """ Count the points and segments in every track, which means
+        parsing each one (and saving its point cache). Tracks that can't be
+        read are reported and left out.
+        """
+        self._execute("SELECT sha1, path FROM %s" % _check(self.track_table))
+        tracks = self._cursor.fetchall()
+        rows = []
+        failed = 0
+        for counter, (sha1, path) in enumerate(tracks, 1):
+            try:
+                points = get_point_cache(os.path.join(self.library_dir, path))
+            except Exception as e:
+                print("Couldn't count points in %s: %s" % (path, e))
+                failed += 1
+            else:
+                rows.append((points.point_count, points.segment_count, sha1))
+            if counter % 100 == 0:
+                print("\tCounted points in %i/%i tracks" % (counter,
+                                                            len(tracks)))
+        if failed:
+            print("Couldn't count points in %i tracks" % failed)
+        return rows
+
+    def _migrate_to_4(self, rows):
+        """ Add the point and segment counts (see _prepare_migration_to_4),
+        and the indexes
+        """
+        table = _check(self.track_table)
+        for column in ("point_count", "segment_count"):
+            sql = "ALTER TABLE %s ADD COLUMN %s %s"
+            sqltype = _TYPE_LOOKUP[_TRACK_ATTRIBUTES[column]]
+            self._execute(sql % (table, column, sqltype))
+        sql = "UPDATE %s SET point_count = ?, segment_count = ? WHERE sha1 = ?"
+        self._executemany(sql % table, rows)
+        self._create_track_indexes()
+
+    def _prepare_migration_to_5(self):
+        """ Work out the spatial grid rows for the existing tracks, from
+        their point caches. Tracks that can't be read are reported and left
+        out.
+        """
+        self._execute("SELECT sha1, path FROM %s" % _check(self.track_table))
+        tracks = self._cursor.fetchall()
+        rows = []
+        for counter, (sha1, path) in enumerate(tracks, 1):
+            path = os.path.join(self.library_dir, path)
+            try:
+                rows.extend(self._get_grid_rows(sha1, path))
+            except Exception as e:
+                print("Couldn't add %s to the spatial grid: %s" % (path, e))
+            if counter % 100 == 0:
+                print("\tGridded %i/%i tracks" % (counter, len(tracks)))
+        return rows
+
+    def _migrate_to_5(self, rows):
+        """ Add the spatial grid, with the existing tracks filed in it (see
+        _prepare_migration_to_5)
+        """
+        self._create_grid_table()
+        self._executemany(self._get_grid_insert_sql(), rows)
+
+    def _migrate_to_6(self):
+        """ Give the track table an explicit integer primary key. The
+        spatial index refers to tracks by rowid, and without one, a VACUUM
+        is free to renumber them.
+        """
+        table = _check(self.track_table)
+        columns = ", ".join(_check(sorted(_TRACK_ATTRIBUTES)))
+        self._create_track_table("%s_new" % table)
+        sql = "INSERT INTO %s_new (id, %s) SELECT rowid, %s FROM %s"
+        self._execute(sql % (table, columns, columns, table))
+        # This also drops the indexes and triggers on the old table
+        self._execute("DROP TABLE %s" % table)
+        self._execute("ALTER TABLE %s_new RENAME TO %s" % (table, table))
+        self._create_track_indexes()
+        if self._table_exists(_check(self.spatial_index)):
+            self._create_spatial_index_triggers()
+        self._create_grid_trigger()
+
+    def _prepare_migration_to_7(self):
+        """ Work out the levels of detail for the existing tracks, which
+        ingest now does, so that drawing doesn't have to. They're saved in
+        the vault, so there's nothing to pass on to _migrate_to_7.
+        """
+        self._execute("SELECT path FROM %s" % _check(self.track_table))
+        paths = [row[0] for row in self._cursor.fetchall()]
+        for counter, path in enumerate(paths, 1):
+            path = os.path.join(self.library_dir, path)
+            try:
+                get_lod(path, get_point_cache(path))
+            except Exception as e:
+                print("Couldn't simplify %s: %s" % (path, e))
+            if counter % 100 == 0:
+                print("\tSimplified %i/%i tracks" % (counter, len(paths)))
+
+    def _migrate_to_7(self, prepared):
+        """ Nothing in the database changes: the levels of detail are all
+        in the vault (see _prepare_migration_to_7)
+        """
+        pass
+
     def _create_global_table(self):
         table_name = _check(self.global_table)
         lib_dir = _check(self.library_dir)
@@ -187,10 +441,14 @@ class TrackLibraryDB(object):
         sql = ["INSERT INTO %s (" % table_name,
                "'parameter', 'value') "
                "VALUES ('library_dir', '%s');" % lib_dir]
-        return self._execute("\n".join(sql))
+        self._execute("\n".join(sql))
+        self._set_schema_version(SCHEMA_VERSION)
 
-    def _create_track_table(self):
-        columns = []
+    def _create_track_table(self, table_name=None):
+        """ Create the track table (or one like it, called table_name). The
+        id is what the spatial index refers to the tracks by.
+        """
+        columns = ["id INTEGER PRIMARY KEY"]
         for name in sorted(_TRACK_ATTRIBUTES):
             name = _check(name)
             type_ = _TRACK_ATTRIBUTES[name]
@@ -199,62 +457,351 @@ class TrackLibraryDB(object):
 
         sql = """ CREATE TABLE %s (
                     %s,
-                    PRIMARY KEY (sha1)
-            );""" % (self.track_table, ",\n".join(columns))
+                    UNIQUE (sha1)
+            );""" % (_check(table_name or self.track_table),
+                     ",\n".join(columns))
+        return self._execute(sql)
+
+    def _create_track_indexes(self):
+        """ Indexes for the range queries that get_tracks makes. Each has
+        the other end of the range as its second column, so that both ends
+        can be checked without going to the table.
+        """
+        table = _check(self.track_table)
+        indexes = {"start_time": ("min_time", "max_time"),
+                   "end_time": ("max_time", "min_time"),
+                   "speed": ("max_speed", "min_speed"),
+                   "length": ("length_3d", "length_2d")}
+        for name, columns in sorted(indexes.items()):
+            sql = "CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)"
+            self._execute(sql % (table, name, table,
+                                 ", ".join(_check(columns))))
+
+    def _create_manifest_table(self):
+        """ The manifest records the size, modification time and inode of
+        each file we've hashed, so that we don't need to hash it again
+        unless one of those changes.
+        """
+        sql = """ CREATE TABLE %s (
+                    path STRING,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER,
+                    sha1 STRING,
+                    PRIMARY KEY (path)
+            );""" % _check(self.manifest_table)
         return self._execute(sql)
 
+    def _table_exists(self, name):
+        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+        self._execute(sql, name)
+        return self._cursor.fetchone() is not None
+
+    def _create_spatial_index(self):
+        """ Create an R*Tree index on the bounding boxes of the tracks, and
+        the triggers that keep it in step with the track table. If the
+        database predates the index, it gets filled from the existing
+        tracks. Not every build of sqlite has R*Tree support: if it's
+        missing, get_tracks just doesn't use it.
+        """
+        index = _check(self.spatial_index)
+        table = _check(self.track_table)
+        columns = ", ".join(_SPATIAL_COLUMNS)
+        # The R*Tree needs an integer id, so we use the rowid of the track
+        # (which, from schema version 6, is its id column)
+        sql = ["CREATE VIRTUAL TABLE %s USING rtree(id, %s);" % (index,
+                                                                 columns),
+               "INSERT INTO %s SELECT rowid, %s FROM %s;" % (index, columns,
+                                                            table)]
+        try:
+            with self.transaction():
+                for statement in sql:
+                    self._execute(statement)
+                self._create_spatial_index_triggers()
+        except sqlite3.OperationalError as e:
+            print("Warning: not using a spatial index (%s)" % e)
+            self._spatial_index_present = False
+            return
+        self._spatial_index_present = True
+
+    def _create_spatial_index_triggers(self):
+        """ The triggers that keep the spatial index in step with the track
+        table
+        """
+        index = _check(self.spatial_index)
+        table = _check(self.track_table)
+        new_columns = ", ".join("new.%s" % c for c in _SPATIAL_COLUMNS)
+        updates = ", ".join("%s = new.%s" % (c, c) for c in _SPATIAL_COLUMNS)
+        sql = ["""CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN
+                      INSERT INTO %s VALUES (new.rowid, %s);
+                  END;""" % (index, table, index, new_columns),
+               """CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN
+                      DELETE FROM %s WHERE id = old.rowid;
+                  END;""" % (index, table, index),
+               """CREATE TRIGGER %s_update AFTER UPDATE ON %s BEGIN
+                      UPDATE %s SET id = new.rowid, %s WHERE id = old.rowid;
+                  END;""" % (index, table, index, updates)]
+        for statement in sql:
+            self._execute(statement)
+
+    def _create_grid_table(self):
+        """ The spatial grid lists the chunks of each track that pass through
+        each cell (see spatialgrid.py), along with the bounds of the chunk.
+        The rows for a track are removed along with it.
+        """
+        grid = _check(self.grid_table)
+        sql = [""" CREATE TABLE %s (
+                    cell INTEGER,
+                    sha1 STRING,
+                    segment INTEGER,
+                    start_point INTEGER,
+                    end_point INTEGER,
+                    min_latitude FLOAT,
+                    max_latitude FLOAT,
+                    min_longitude FLOAT,
+                    max_longitude FLOAT
+            );""" % grid,
+               "CREATE INDEX %s_cell ON %s (cell);" % (grid, grid),
+               "CREATE INDEX %s_sha1 ON %s (sha1);" % (grid, grid)]
+        with self.transaction():
+            for statement in sql:
+                self._execute(statement)
+            self._create_grid_trigger()
+
+    def _create_grid_trigger(self):
+        """ The trigger that removes a track's rows from the spatial grid
+        along with it
+        """
+        grid = _check(self.grid_table)
+        table = _check(self.track_table)
+        sql = """CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN
+                     DELETE FROM %s WHERE sha1 = old.sha1;
+                 END;""" % (grid, table, grid)
+        self._execute(sql)
+
+    def _get_grid_rows(self, sha1, path):
+        """ Get the rows of the spatial grid for the track with the given
+        hash, from its point cache
+        """
+        rows = []
+        for chunk in get_chunks(get_point_cache(path)):
+            for cell in get_chunk_cells(*chunk[3:]):
+                rows.append((cell, sha1) + chunk)
+        return rows
+
+    def _get_grid_insert_sql(self):
+        sql = "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        return sql % _check(self.grid_table)
+
     def create(self):
         assert not self.is_present()
         self._create_global_table()
         self._create_track_table()
+        self._create_manifest_table()
+        self._create_spatial_index()
+        self._create_track_indexes()
+        self._create_grid_table()
+
+    def _get_manifest(self):
+        """ Get the manifest as a dictionary of
+          relative path: (size, mtime_ns, inode, sha1)
+        """
+        sql = "SELECT path, size, mtime_ns, inode, sha1 FROM %s"
+        self._execute(sql % _check(self.manifest_table))
+        return dict((row[0], tuple(row[1:]))
+                    for row in self._cursor.fetchall())
+
+    def _update_manifest(self, rows):
+        """ Record (relative path, size, mtime_ns, inode, sha1) for each of
+        the given files
+        """
+        sql = "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)"
+        with self.transaction():
+            self._executemany(sql % _check(self.manifest_table), rows)
+
+    def get_sha1s(self):
+        """ Get the hashes of every track in the database """
+        sql = "SELECT sha1 FROM %s" % _check(self.track_table)
+        self._execute(sql)
+        return set(row[0] for row in self._cursor.fetchall())
 
     def clean_tracks(self, execute=False):
-        to_delete = set()
-        for eachtrack in self.get_tracks():
+        """ Find the tracks in the database whose files are missing from the
+        vault. If execute is True, remove them from the database.
+        """
+        # Only keep what we need of the missing tracks, rather than every
+        # track in the library
+        to_delete = {}
+        for eachtrack in self.iter_tracks():
             if self.check_vault(eachtrack) is False:
-                to_delete.add(eachtrack)
-        print("\n".join([a.path for a in sorted(to_delete)]))
+                to_delete[eachtrack.path] = eachtrack.sha1
+        print("\n".join(sorted(to_delete)))
+        if execute:
+            removed = self.remove_shas(to_delete.values())
+            print("Removed %s tracks" % removed)
 
     def remove_sha(self, sha):
-        sql = 'DELETE FROM %s WHERE sha1 = "%s"'
-        sql = sql % (self.track_table, _check(sha))
-        return self._execute(sql)
+        return self.remove_shas([sha])
+
+    def remove_shas(self, shas):
+        """ Remove the tracks with the given hashes from the database, in a
+        single transaction. Returns the number of tracks removed.
+        """
+        sql = "DELETE FROM %s WHERE sha1 = ?" % _check(self.track_table)
+        with self.transaction():
+            self._executemany(sql, ((sha,) for sha in shas))
+            return self._cursor.rowcount
 
-    def add_new_tracks(self):
-        return self.add_track_directory(self.library_dir)
+    def add_new_tracks(self, jobs=1, verify=False):
+        return self.add_track_directory(self.library_dir, jobs=jobs,
+                                        verify=verify)
 
-    def add_track_directory(self, path):
-        tracks = tracks_from_path(path)
+    def add_track_directory(self, path, jobs=1, verify=False):
+        """ Add all the gpx files in a directory that aren't already in the
+        database. The hashing and parsing is spread over "jobs" worker
+        processes (0 or None means one per cpu), while this process does all
+        the writing to the database.
+
+        Files whose size, modification time and inode match the manifest
+        aren't hashed again, unless verify is True.
+
+        Files that can't be read don't stop the others from being added:
+        they're reported at the end, in path order.
+        """
+        tracks = sorted(os.path.realpath(t) for t in tracks_from_path(path))
         print("Adding %s tracks to database" % len(tracks))
-        actual_added = 0
-        for counter, eachtrack in enumerate(tracks):
-            if counter and counter % 100 == 0:
-                print("Scanned %s/%s tracks" % (counter, len(tracks)))
-            t = TrackPath(os.path.realpath(eachtrack))
-            if self.has_track(t):
+        if verify:
+            manifest = {}
+        else:
+            manifest = self._get_manifest()
+        known_sha1s = {}
+        to_hash = []
+        file_stats = {}
+        errors = []
+        for trackpath in tracks:
+            relative_path = os.path.relpath(trackpath, self.library_dir)
+            try:
+                stat = os.stat(trackpath)
+            except OSError as e:
+                # e.g. it's been deleted since we listed the directory
+                errors.append((trackpath, "%s: %s" % (e.__class__.__name__,
+                                                      e)))
                 continue
-            actual_added += 1
-            self.add_track(t)
+            file_stat = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            entry = manifest.get(relative_path)
+            if entry is not None and entry[:3] == file_stat:
+                known_sha1s[trackpath] = entry[3]
+                continue
+            file_stats[trackpath] = (relative_path,) + file_stat
+            to_hash.append(trackpath)
+        print("%s files unchanged since the last scan" % len(known_sha1s))
+        if jobs == 0:
+            jobs = None
+        if jobs == 1:
+            pool = None
+            mapper = map
+        else:
+            pool = Pool(jobs)
+            mapper = partial(pool.imap, chunksize=16)
+        actual_added = 0
+        try:
+            manifest_rows = []
+            hashed = mapper(_hash_track, to_hash)
+            for counter, (trackpath, sha1, error) in enumerate(hashed):
+                if counter and counter % 100 == 0:
+                    print("Hashed %s/%s tracks" % (counter, len(to_hash)))
+                if error is not None:
+                    errors.append((trackpath, error))
+                    continue
+                known_sha1s[trackpath] = sha1
+                manifest_rows.append(file_stats[trackpath] + (sha1,))
+            self._update_manifest(manifest_rows)
+
+            to_scan = []
+            # Start with what's in the database, so that two identical
+            # files are still only one track
+            seen = self.get_sha1s()
+            for trackpath in tracks:
+                sha1 = known_sha1s.get(trackpath)
+                if sha1 is None or sha1 in seen:
+                    continue
+                seen.add(sha1)
+                to_scan.append((trackpath, sha1))
+
+            batch = []
+            for trackpath, data, error in mapper(_scan_track, to_scan):
+                if error is not None:
+                    errors.append((trackpath, error))
+                    continue
+                batch.append(TrackRecord(data))
+                if len(batch) >= _INSERT_BATCH_SIZE:
+                    actual_added += self.add_tracks(batch)
+                    batch = []
+            actual_added += self.add_tracks(batch)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        for trackpath, error in sorted(errors):
+            print("Error reading %s: %s" % (trackpath, error))
         print("Added %s new tracks" % actual_added)
+        if errors:
+            print("Failed to add %s tracks" % len(errors))
+        return errors
 
-    def add_track(self, track):
+    def _get_track_row(self, track):
+        """ Get the values to insert into the track table for a track """
         self.assert_vault(track)
         results = []
         for column in sorted(_TRACK_ATTRIBUTES):
             value = getattr(track, column)
             if column == "path":
                 # Store relative paths
-                value = value[len(self.library_dir) + 1:]
+                value = os.path.relpath(value, self.library_dir)
             if value.__class__ in _CONVERTER:
                 results.append(_CONVERTER[value.__class__][0](value))
             else:
                 results.append(value)
         if None in results:
             raise ValueError("Track %s has None values" % track.path)
-        question_marks = ", ".join("?" * len(results))
-        sql = "INSERT INTO %s VALUES (%s)"
-        sql = sql % (_check(self.track_table), question_marks)
-        self._execute(sql, results)
+        return results
+
+    def _get_insert_sql(self):
+        question_marks = ", ".join("?" * len(_TRACK_ATTRIBUTES))
+        columns = ", ".join(_check(sorted(_TRACK_ATTRIBUTES)))
+        sql = "INSERT INTO %s (%s) VALUES (%s)"
+        return sql % (_check(self.track_table), columns, question_marks)
+
+    def _get_select_columns(self):
+        """ The columns to select to make a track object. We name them,
+        rather than using *, because migrated databases have them in a
+        different order.
+        """
+        table = _check(self.track_table)
+        return ", ".join("%s.%s" % (table, c)
+                         for c in _check(sorted(_TRACK_ATTRIBUTES)))
+
+    def add_tracks(self, tracks):
+        """ Add several tracks to the database, and the spatial grid, in a
+        single transaction. The grid is worked out from the point caches,
+        which are made if they're missing (when adding a directory, the
+        worker processes have already done that). Returns the number of
+        tracks added.
+        """
+        rows = [self._get_track_row(t) for t in tracks]
+        grid_rows = []
+        for track in tracks:
+            grid_rows.extend(self._get_grid_rows(track.sha1, track.path))
+        with self.transaction():
+            self._executemany(self._get_insert_sql(), rows)
+            self._executemany(self._get_grid_insert_sql(), grid_rows)
+        return len(rows)
+
+    def add_track(self, track):
+        self.add_tracks([track])
+        # Save the levels of detail while we're here, so that the first
+        # render doesn't have to work them out
+        get_lod(track.path, get_point_cache(track.path))
         return self.get_track(track.sha1)
 
     def get_vault_path(self, track):
@@ -276,8 +823,12 @@ class TrackLibraryDB(object):
     def has_track(self, track):
         """ Check if the given track is in the database (not necessarily the
         vault) """
+        return self.has_sha1(track.sha1)
+
+    def has_sha1(self, sha1):
+        """ Check if a track with the given hash is in the database """
         try:
-            self._get_track(track.sha1, allow_multiple=True)
+            self._get_track(sha1, allow_multiple=True)
         except Exception:
             return False
         return True
@@ -293,8 +844,8 @@ class TrackLibraryDB(object):
 
         * Fine as in, it will break everything else, but this should work.
         """
-        sql = "SELECT * FROM %s WHERE sha1 = ?"
-        sql = sql % _check(self.track_table)
+        sql = "SELECT %s FROM %s WHERE sha1 = ?"
+        sql = sql % (self._get_select_columns(), _check(self.track_table))
         self._execute(sql, sha1)
         raw_tuples = self._cursor.fetchall()
         if len(raw_tuples) == 0:
@@ -310,52 +861,170 @@ class TrackLibraryDB(object):
             return return_list
         return return_list[0]
 
-    def get_tracks(self, **kwargs):
-        """ Each argument should be the name of an attribute of the track. The
-        value of each argument should be a range, as a tuple. E.g.
-          min_elevation = (0, 100)
-        Will narrow down searches to those tracks whose minimum elevation is
-        between 0 and 100.
-        To specify a one-ended range, use None:
-          length_3d=(None, 1000)
-        Will narrow down to all tracks that are less than 1000 long.
+    def _get_tracks_query(self, select, kwargs):
+        """ Build the query for get_tracks, iter_tracks and count_tracks.
+        Returns the sql and the list of variables to go with it.
         """
-        sql = "SELECT * FROM %s" % _check(self.track_table)
+        table = _check(self.track_table)
+        index = _check(self.spatial_index)
         clauses = []
-        min_template = "%s >= ?"
-        max_template = "%s <= ?"
+        # Bounding box ranges also get checked against the spatial index,
+        # which finds the candidates without scanning the whole table. The
+        # index stores 32 bit floats, rounded outwards, so it can only
+        # answer the checks that rounding outwards can't get wrong: a max_*
+        # at least something, or a min_* at most something. Everything is
+        # still checked exactly in the track table as well.
+        spatial_clauses = []
+        min_template = "%s.%s >= ?"
+        max_template = "%s.%s <= ?"
         for key, value in kwargs.items():
             if key == "namefilter":
                 # TODO: This could be more specific
-                clauses.append(("path like ?", "%%%s%%" % value))
+                clauses.append(("%s.path like ?" % table, "%%%s%%" % value))
                 continue
             if key == "nameregex":
                 def regexp(y, x, search=re.search):
                     return 1 if search(y, x) else 0
                 self._conn.create_function('regexp', 2, regexp)
-                clauses.append(("path regexp ?", value))
+                clauses.append(("%s.path regexp ?" % table, value))
                 continue
-            param_class = value[0].__class__
-            if param_class in _CONVERTER:
-                converter = _CONVERTER[param_class][0]
+            key = _check(key)
+            # Either end of the range could be None, so get the class from
+            # whichever isn't
+            ends = [v for v in value if v is not None]
+            if ends and ends[0].__class__ in _CONVERTER:
+                converter = _CONVERTER[ends[0].__class__][0]
                 value = tuple(map(converter, list(value)))
             min_, max_ = value
             if min_ is not None:
-                clauses.append((min_template % key, min_))
+                clauses.append((min_template % (table, key), min_))
+                if key in _SPATIAL_COLUMNS and key.startswith("max_"):
+                    spatial_clauses.append((min_template % (index, key),
+                                            min_))
             if max_ is not None:
-                clauses.append((max_template % key, max_))
+                clauses.append((max_template % (table, key), max_))
+                if key in _SPATIAL_COLUMNS and key.startswith("min_"):
+                    spatial_clauses.append((max_template % (index, key),
+                                            max_))
+        if spatial_clauses and self._spatial_index_present:
+            sql = "SELECT %s FROM %s JOIN %s ON %s.id = %s.id"
+            sql = sql % (select, index, table, table, index)
+            clauses = spatial_clauses + clauses
+        else:
+            sql = "SELECT %s FROM %s" % (select, table)
         if clauses:
             sql += " WHERE "
             sql += " AND ".join([c[0] for c in clauses])
-            self._execute(sql, [c[1] for c in clauses])
-        else:
-            self._execute(sql)
-        raw_tuples = self._cursor.fetchall()
-        return_set = set()
-        for raw_tuple in raw_tuples:
-            _track_object = self._get_track_object_from_tuple(raw_tuple)
-            return_set.add(_track_object)
-        return return_set
+        return sql, [c[1] for c in clauses]
+
+    def get_tracks(self, **kwargs):
+        """ Each argument should be the name of an attribute of the track. The
+        value of each argument should be a range, as a tuple. E.g.
+          min_elevation = (0, 100)
+        Will narrow down searches to those tracks whose minimum elevation is
+        between 0 and 100.
+        To specify a one-ended range, use None:
+          length_3d=(None, 1000)
+        Will narrow down to all tracks that are less than 1000 long.
+        """
+        return set(self.iter_tracks(**kwargs))
+
+    def iter_tracks(self, **kwargs):
+        """ Like get_tracks, but yield the tracks one at a time as they're
+        read from the database, rather than loading them all at once. This
+        uses its own cursor, so it's fine to use the database while
+        iterating.
+        """
+        sql, variables = self._get_tracks_query(self._get_select_columns(),
+                                                kwargs)
+        self.debug("Executing:")
+        self.debug(sql)
+        self.debug("Variables: %s" % (variables,))
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(sql, variables)
+            while True:
+                raw_tuples = cursor.fetchmany(_FETCH_BATCH_SIZE)
+                if not raw_tuples:
+                    break
+                for raw_tuple in raw_tuples:
+                    yield self._get_track_object_from_tuple(raw_tuple)
+        finally:
+            cursor.close()
+
+    def get_gridded_sha1s(self):
+        """ Get the hashes of the tracks that are in the spatial grid. Any
+        that aren't (e.g. if adding them to it failed in a migration)
+        can't be found by get_point_ranges.
+        """
+        sql = "SELECT DISTINCT sha1 FROM %s" % _check(self.grid_table)
+        self._execute(sql)
+        return set(row[0] for row in self._cursor.fetchall())
+
+    def get_point_ranges(self, min_latitude, max_latitude, min_longitude,
+                         max_longitude):
+        """ Find the parts of tracks that pass through a region, using the
+        spatial grid. Returns a dictionary of sha1: list of (segment, start,
+        end) ranges of points (see PointCache.get_ranges), for just the
+        tracks that have points in the region. Every pair of points that
+        could cross the region is included, so the lines into and out of
+        it aren't lost.
+        """
+        grid = _check(self.grid_table)
+        clauses = ["max_latitude >= ?", "min_latitude <= ?",
+                   "max_longitude >= ?", "min_longitude <= ?"]
+        variables = [min_latitude, max_latitude, min_longitude,
+                     max_longitude]
+        cells = get_region_cells(min_latitude, max_latitude, min_longitude,
+                                 max_longitude)
+        if cells is not None:
+            # Without the cells, we just check every chunk's bounds
+            cell_clauses = ["cell = ?"]
+            variables.append(WIDE_CELL)
+            for first, last in cells:
+                cell_clauses.append("cell BETWEEN ? AND ?")
+                variables.extend((first, last))
+            clauses.append("(%s)" % " OR ".join(cell_clauses))
+        sql = "SELECT sha1, segment, start_point, end_point FROM %s WHERE %s"
+        self._execute(sql % (grid, " AND ".join(clauses)), variables)
+        ranges = {}
+        for sha1, segment, start, end in self._cursor.fetchall():
+            ranges.setdefault(sha1, set()).add((segment, start, end))
+        return dict((sha1, merge_ranges(chunks))
+                    for sha1, chunks in ranges.items())
+
+    def get_tracks_in_region(self, min_latitude, max_latitude,
+                             min_longitude, max_longitude, **kwargs):
+        """ Like get_tracks (with the same keyword arguments), but only for
+        the tracks that actually pass through the region, rather than those
+        whose bounding box overlaps it. Each track's point_ranges are set
+        to the parts of it in the region (see get_point_ranges), so that
+        drawing it only needs to read those points. Tracks missing from
+        the grid are included whole, since we can't tell where they go.
+        """
+        ranges = self.get_point_ranges(min_latitude, max_latitude,
+                                       min_longitude, max_longitude)
+        gridded = self.get_gridded_sha1s()
+        kwargs["min_latitude"] = (None, max_latitude)
+        kwargs["max_latitude"] = (min_latitude, None)
+        kwargs["min_longitude"] = (None, max_longitude)
+        kwargs["max_longitude"] = (min_longitude, None)
+        tracks = set()
+        for track in self.iter_tracks(**kwargs):
+            if track.sha1 in ranges:
+                track.point_ranges = ranges[track.sha1]
+                tracks.add(track)
+            elif track.sha1 not in gridded:
+                tracks.add(track)
+        return tracks
+
+    def count_tracks(self, **kwargs):
+        """ Count the tracks that get_tracks would return, with the same
+        arguments, without reading them.
+        """
+        sql, variables = self._get_tracks_query("COUNT(*)", kwargs)
+        self._execute(sql, variables)
+        return self._cursor.fetchone()[0]
 
 
 class OldTrackLibrary(dict):
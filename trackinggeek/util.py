@@ -1,6 +1,12 @@
 import math
 import os
 
+import numpy as np
+
+# The same figures gpxpy uses, so that our distances match its
+EARTH_RADIUS = 6378.137 * 1000
+ONE_DEGREE = (2 * math.pi * EARTH_RADIUS) / 360
+
 def add_num_to_path(path, number):
     """ Convert an unnumbered path into a numbered one.
     E.g. blah.txt -> blah.0001.txt
@@ -34,3 +40,61 @@ def mercator_adjust(lat):
     return 180 / math.pi * math.log(math.tan(math.pi / 4 + lat *
                                                 (math.pi / 180) / 2))
 
+
+def mercator_adjust_array(lats):
+    """ Create mercator projection-adjusted latitudes for a whole array of
+    latitudes at once
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    return 180 / np.pi * np.log(np.tan(np.pi / 4 + lats * (np.pi / 180) / 2))
+
+
+def mercator_unadjust(merc_lat):
+    """ Turn a mercator projection-adjusted latitude back into a latitude
+    (the inverse of mercator_adjust)
+    """
+    return 180 / math.pi * (2 * math.atan(math.exp(merc_lat * math.pi /
+                                                   180)) - math.pi / 2)
+
+
+def distances_between(latitudes, longitudes, elevations=None):
+    """ Get the distance in metres between each consecutive pair of points,
+    worked out the same way as gpxpy.geo.distance (i.e. from each point
+    back to the one before it). If elevations are given (with NaN for
+    missing ones) this is the 3D distance where both points have one.
+    """
+    lat1 = latitudes[1:]
+    lat2 = latitudes[:-1]
+    lon_diff = longitudes[1:] - longitudes[:-1]
+    lat_diff = lat1 - lat2
+    coef = np.cos(np.radians(lat1))
+    distances = np.hypot(lat_diff, lon_diff * coef) * ONE_DEGREE
+    if elevations is not None:
+        ele_diff = elevations[1:] - elevations[:-1]
+        distances = np.where(np.isnan(ele_diff), distances,
+                             np.hypot(distances, ele_diff))
+    # Like gpxpy, use the haversine distance for points that are far apart,
+    # where elevation makes no real difference
+    far = (np.abs(lat_diff) > .2) | (np.abs(lon_diff) > .2)
+    if far.any():
+        rad1 = np.radians(lat1[far])
+        rad2 = np.radians(lat2[far])
+        a = np.sin((rad1 - rad2) / 2) ** 2 + \
+            np.sin(np.radians(lon_diff[far]) / 2) ** 2 * \
+            np.cos(rad1) * np.cos(rad2)
+        distances[far] = EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+    return distances
+
+
+def speeds_between(latitudes, longitudes, elevations, times):
+    """ Get the speed in m/s between each consecutive pair of points, as
+    gpxpy's GPXTrackPoint.speed_between would. Times are unix seconds.
+    Where the speed can't be worked out (no time, or no time difference),
+    it is NaN.
+    """
+    distances = distances_between(latitudes, longitudes, elevations)
+    seconds = np.abs(times[1:] - times[:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speeds = distances / seconds
+    speeds[~(seconds > 0)] = np.nan
+    return speeds